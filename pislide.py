@@ -15,14 +15,18 @@
 # based on cam.py by Phil Burgess / Paint Your Dragon for Adafruit Industries.
 # BSD license, all text above must be included in any redistribution.
 
-import wiringpi2
 import atexit
 import cPickle as pickle
 import errno
 import fnmatch
+import hashlib
 import io
+import json
+import math
 import os
 import pygame
+import Queue
+import select
 import threading
 import signal
 import sys
@@ -33,23 +37,93 @@ from subprocess import call
 #from time import sleep
 
 
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from fractions import gcd
+
+try:
+    import wiringpi2
+except ImportError:
+    wiringpi2 = None              # off the Pi; only the simulated backend works,
+                                  # and makeBackend refuses to fall back to it
+
+try:
+    import numpy
+except ImportError:
+    numpy = None                  # motion profiles fall back to plain Python
 
 # UI classes ---------------------------------------------------------------
 
+# Assets loads each PNG in the icons directory at most once, the first
+# time it is asked for, and converts it to the display's pixel format
+# (keeping per-pixel alpha only for images that actually have
+# transparent pixels) so blits don't convert pixel by pixel.  Images
+# that can't be loaded are reported once and come back as None.
+
+class Assets:
+
+    def __init__(self, path):
+      self.path     = path
+      self.images   = {}  # name -> converted Surface (or None if missing)
+      self.loads    = 0
+      self.loadTime = 0.0 # seconds spent loading and converting
+      self.bytes    = 0   # pixel memory held
+      self.lock     = threading.Lock() # preload() runs on another thread
+
+    def get(self, name):
+      try:
+        return self.images[name]
+      except KeyError:
+        with self.lock:
+          if name not in self.images:
+            self.images[name] = self.load(name)
+          return self.images[name]
+
+    def preload(self, names):     # load names on a background thread
+      loader = threading.Thread(target=lambda: [self.get(n) for n in names])
+      loader.daemon = True
+      loader.start()
+
+    def load(self, name):
+      start = monotonic()
+      try:
+        image = pygame.image.load(self.path + '/' + name + '.png')
+      except pygame.error, e:
+        print 'Missing icon %s: %s' % (name, e)
+        return None
+      if pygame.display.get_surface():
+        if image.get_flags() & SRCALPHA:
+          w, h = image.get_size()
+          if pygame.mask.from_surface(image, 254).count() == w * h:
+            image = image.convert()       # alpha channel but fully opaque
+          else:
+            image = image.convert_alpha()
+        else:
+          image = image.convert()
+      self.loads    += 1
+      self.loadTime += monotonic() - start
+      self.bytes    += image.get_pitch() * image.get_height()
+      return image
+
+    def report(self):
+      print "Assets: %d loaded in %.0fms, %dKB" % (
+        self.loads, 1000.0 * self.loadTime, self.bytes / 1024)
+
 # Icon is a very simple bitmap class, just associates a name and a pygame
-# image (PNG loaded from icons directory) for each.
-# There isn't a globally-declared fixed list of Icons.  Instead, the list
-# is populated at runtime from the contents of the 'icons' directory.
+# image (PNG from the icons directory, through assets) for each.
+# There isn't a globally-declared fixed list of Icons.  Instead, the
+# icons dict is populated at runtime from the contents of the 'icons'
+# directory, keyed by name.
 
-class Icon:
+class Icon(object):
 
     def __init__(self, name):
       self.name = name
-      try:
-        self.bitmap = pygame.image.load(iconPath + '/' + name + '.png')
-      except:
-        pass
+
+    @property
+    def bitmap(self):             # loaded on first draw
+      return assets.get(self.name)
 
 # Button is a simple tappable screen region.  Each has:
 #  - bounding rect ((X,Y,W,H) in pixels)
@@ -64,7 +138,7 @@ class Icon:
 # used, for example, to center an Icon by creating a passive Button the
 # width of the full screen, but with other buttons left or right that
 # may take input precedence (e.g. the Effect labels & buttons).
-# After Icons are loaded at runtime, a pass is made through the global
+# After Icons are named at runtime, a pass is made through the global
 # buttons[] list to assign the Icon objects (from names) to each Button.
 
 class Button:
@@ -78,46 +152,1029 @@ class Button:
       self.fg       = None # Foreground Icon name
       self.callback = None # Callback function
       self.value    = None # Value passed to callback
+      self.label    = None # Text centered atop the icons, if any
+      self.dirty    = True # Needs recompositing on the next partial repaint
       for key, value in kwargs.iteritems():
         if   key == 'color': self.color    = value
         elif key == 'bg'   : self.bg       = value
         elif key == 'fg'   : self.fg       = value
         elif key == 'cb'   : self.callback = value
         elif key == 'value': self.value    = value
+        elif key == 'label': self.label    = value
+      self.x2 = rect[0] + rect[2] - 1 # Inclusive right/bottom edges
+      self.y2 = rect[1] + rect[3] - 1
+
+    def contains(self, pos):
+      return (self.rect[0] <= pos[0] <= self.x2 and
+              self.rect[1] <= pos[1] <= self.y2)
+
+    def fire(self):
+      if self.callback:
+        if self.value is None: self.callback()
+        else:                  self.callback(self.value)
 
     def selected(self, pos):
-      x1 = self.rect[0]
-      y1 = self.rect[1]
-      x2 = x1 + self.rect[2] - 1
-      y2 = y1 + self.rect[3] - 1
-      if ((pos[0] >= x1) and (pos[0] <= x2) and
-          (pos[1] >= y1) and (pos[1] <= y2)):
-        if self.callback:
-          if self.value is None: self.callback()
-          else:                  self.callback(self.value)
+      if self.contains(pos):
+        self.fire()
         return True
       return False
 
     def draw(self, screen):
       if self.color:
         screen.fill(self.color, self.rect)
-      if self.iconBg:
-        screen.blit(self.iconBg.bitmap,
-          (self.rect[0]+(self.rect[2]-self.iconBg.bitmap.get_width())/2,
-           self.rect[1]+(self.rect[3]-self.iconBg.bitmap.get_height())/2))
-      if self.iconFg:
-        screen.blit(self.iconFg.bitmap,
-          (self.rect[0]+(self.rect[2]-self.iconFg.bitmap.get_width())/2,
-           self.rect[1]+(self.rect[3]-self.iconFg.bitmap.get_height())/2))
+      for icon in (self.iconBg, self.iconFg):
+        bitmap = icon and icon.bitmap
+        if bitmap:
+          screen.blit(bitmap,
+            (self.rect[0]+(self.rect[2]-bitmap.get_width())/2,
+             self.rect[1]+(self.rect[3]-bitmap.get_height())/2))
+      if self.label:
+        text = textCache.render(self.label, (fontFace, smallfont, True), whitefont)
+        screen.blit(text,
+          (self.rect[0]+(self.rect[2]-text.get_width())/2,
+           self.rect[1]+(self.rect[3]-text.get_height())/2))
+
+    def setLabel(self, text):
+      if text != self.label:
+        self.label = text
+        self.dirty = True
 
     def setBg(self, name):
       if name is None:
         self.iconBg = None
       else:
-        for i in icons:
-          if name == i.name:
-            self.iconBg = i
-            break
+        self.iconBg = icons.get(name)
+        if self.iconBg is None:
+          print 'Missing icon ' + name
+      self.dirty = True
+
+# HitGrid maps a touch position straight to the Button under it.  The
+# screen is divided into square cells as large as the buttons' layout
+# allows (the GCD of all their edges) so every cell lies wholly within
+# or outside each Button, and each cell holds the index of the first
+# Button in the list covering it, the same precedence as scanning.
+
+class HitGrid:
+
+    def __init__(self, buttons, width=320, height=240):
+      self.buttons = buttons
+      cell = 0
+      for b in buttons:
+        for n in b.rect: cell = gcd(cell, n)
+      self.cell  = cell or 1
+      self.cols  = (width  + self.cell - 1) / self.cell
+      self.rows  = (height + self.cell - 1) / self.cell
+      self.cells = array('h', [-1]) * (self.cols * self.rows)
+      for i in range(len(buttons) - 1, -1, -1): # first in list written last
+        x, y, w, h = buttons[i].rect
+        for row in range(y / self.cell, min((y + h) / self.cell, self.rows)):
+          base = row * self.cols
+          for col in range(x / self.cell, min((x + w) / self.cell, self.cols)):
+            self.cells[base + col] = i
+
+    def find(self, pos):          # Button at pos, or None
+      col = pos[0] / self.cell
+      row = pos[1] / self.cell
+      if 0 <= col < self.cols and 0 <= row < self.rows:
+        i = self.cells[row * self.cols + col]
+        if i >= 0: return self.buttons[i]
+      return None
+
+# TextCache keeps the most recently rendered label surfaces, keyed by
+# (text, font, color), so a label that flips between a few values (or
+# the same label on a revisited screen) is rasterized only once.  The
+# least recently used surface is dropped when the cache is full.
+
+class TextCache:
+
+    def __init__(self, capacity):
+      self.capacity = capacity
+      self.surfaces = OrderedDict()
+      self.hits     = 0
+      self.misses   = 0
+
+    def render(self, text, fontKey, color):
+      key = (text, fontKey, color)
+      surface = self.surfaces.pop(key, None)
+      if surface is None:
+        self.misses += 1
+        surface = getFont(*fontKey[1:]).render(text, 1, color)
+        if len(self.surfaces) >= self.capacity:
+          self.surfaces.popitem(last=False)
+      else:
+        self.hits += 1
+      self.surfaces[key] = surface # (re)insert as most recently used
+      return surface
+
+# Profiler times the stages of each main loop repaint (event handling,
+# label text, button layer, compositing, display update) with one clock
+# read per stage.  It keeps the last 'window' samples of each stage for
+# a rolling summary, shown as a one line overlay in debug mode, and a
+# histogram of every sample for the dump written on exit.  Disabled,
+# each call returns at once.
+
+class Profiler:
+
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50) # upper bounds, ms
+
+    def __init__(self, window=128):
+      self.enabled = False
+      self.window  = window
+      self.stages  = []   # stage names in first seen order
+      self.recent  = {}   # stage -> deque of recent ms
+      self.counts  = {}   # stage -> histogram counts (last is overflow)
+      self.mark    = None
+
+    def begin(self):
+      if self.enabled: self.mark = monotonic()
+
+    def lap(self, stage):         # time since begin() or the previous lap
+      if not self.enabled or self.mark is None: return
+      t = monotonic()
+      self.add(stage, 1000.0 * (t - self.mark))
+      self.mark = t
+
+    def add(self, stage, ms):
+      if stage not in self.recent:
+        self.stages.append(stage)
+        self.recent[stage] = deque(maxlen=self.window)
+        self.counts[stage] = [0] * (len(self.buckets) + 1)
+      self.recent[stage].append(ms)
+      n = 0
+      while n < len(self.buckets) and ms > self.buckets[n]: n += 1
+      self.counts[stage][n] += 1
+
+    def summary(self):            # rolling mean ms per stage, one line
+      return ' '.join('%s %.1f' % (stage[:4], sum(self.recent[stage]) / len(self.recent[stage]))
+                      for stage in self.stages)
+
+    def dump(self, path):
+      out = open(path, 'w')
+      try:
+        out.write('stage\t' + '\t'.join('<=%gms' % b for b in self.buckets) +
+                  '\t>%gms\tp50\tp95\n' % self.buckets[-1])
+        for stage in self.stages:
+          recent = self.recent[stage]
+          out.write('%s\t%s\t%.3f\t%.3f\n' % (stage,
+            '\t'.join(str(c) for c in self.counts[stage]),
+            percentile(recent, 50), percentile(recent, 95)))
+      finally:
+        out.close()
+
+# Overlay is a dynamic image (status icon, direction arrow) drawn over a
+# screen's background and buttons.  It remembers where it was last
+# flushed to the display so a change only recomposites the union of
+# the old and new bounds rather than the whole screen.
+
+class Overlay:
+
+    def __init__(self):
+      self.image = None # Surface currently shown, or None
+      self.pos   = None # Top left of image
+      self.rect  = None # Bounds of image as it is now
+      self.prior = None # Bounds of image as last flushed to the display
+      self.dirty = True
+
+    def set(self, image, pos):
+      if image is self.image and pos == self.pos: return
+      self.image = image
+      self.pos   = pos
+      if image is None: self.rect = None
+      else:             self.rect = image.get_rect(topleft=pos)
+      self.dirty = True
+
+    def area(self):               # region to recomposite for this change
+      if self.prior and self.rect: return self.prior.union(self.rect)
+      return self.prior or self.rect
+
+    def draw(self, screen):
+      if self.image: screen.blit(self.image, self.pos)
+
+    def flushed(self):
+      self.prior = self.rect
+      self.dirty = False
+
+# Label is an Overlay of one line of text, positioned with xPos.  The
+# text is set on every repaint but only rendered when it changes.
+
+class Label(Overlay):
+
+    def __init__(self, s, y, justify, size, bold=False):
+      Overlay.__init__(self)
+      self.s       = s       # Screen mode (for xPos margins)
+      self.y       = y
+      self.justify = justify # 0 left, 1 right, 2 centered
+      self.size    = size    # Font point size
+      self.bold    = bold
+      self.text    = None
+
+    def setText(self, text):
+      if text == self.text: return
+      self.text = text
+      if not text:
+        self.set(None, None)
+        return
+      myfont = getFont(self.size, self.bold)
+      self.set(textCache.render(text, (fontFace, self.size, self.bold), whitefont),
+               (xPos(text, self.justify, self.s, myfont), self.y))
+
+# Timing -------------------------------------------------------------------
+
+# monotonic() is a clock that never steps (NTP, manual date changes) so
+# deadlines computed from it hold over a day long timelapse.  Python 2
+# has no time.monotonic so CLOCK_MONOTONIC is read through librt.
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    import ctypes, ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                errno_ = ctypes.get_errno()
+                raise OSError(errno_, os.strerror(errno_))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    except (OSError, AttributeError):
+        print 'CLOCK_MONOTONIC unavailable, using time.time'
+        monotonic = time.time
+
+# ShotPlan is the whole timelapse worked out ahead of time, one row per
+# frame, held column-wise in arrays of doubles: the offset from the start
+# at which the frame begins and how long each of its phases lasts, plus
+# the step offsets of each stepper move.
+# timelapseSettings() builds it, the capture thread replays it and the
+# UI reads the remaining time from it.  dump() writes it as text so two
+# plans can be diffed.
+
+class ShotPlan:
+
+    columns = ('start', 'travel', 'slide', 'ramp', 'steps', 'pan', 'settle',
+               'focus', 'exposure', 'pause')
+
+    def __init__(self):
+      for c in self.columns:
+        setattr(self, c, array('d'))
+      self.stepTimes = {}         # step count -> offsets of its steps
+
+    def __len__(self):
+      return len(self.start)
+
+    def append(self, travel, settle, focus, exposure, pause,
+               slide=0.0, ramp=0.0, steps=0, pan=0.0):
+      self.start.append(self.total())
+      self.travel.append(travel)  # the whole travel phase, every axis
+      self.slide.append(slide)    # DC slide motor seconds
+      self.ramp.append(ramp)      # slide ramp at each end, within slide
+      self.steps.append(steps)    # stepper steps, 0 when the DC motor moves
+      self.pan.append(pan)        # head seconds, negative turning back
+      self.settle.append(settle)
+      self.focus.append(focus)
+      self.exposure.append(exposure)
+      self.pause.append(pause)
+
+    def end(self, i):             # offset at which frame i's pause finishes
+      return (self.start[i] + self.travel[i] + self.settle[i] +
+              self.focus[i] + self.exposure[i] + self.pause[i])
+
+    def total(self):
+      if not self.start: return 0.0
+      return self.end(len(self.start) - 1)
+
+    def remaining(self, elapsed):
+      return max(self.total() - elapsed, 0.0)
+
+    def dump(self, out):
+      out.write('frame\t' + '\t'.join(self.columns) + '\n')
+      for i in range(len(self)):
+        out.write('%d\t%s\n' % (i + 1, '\t'.join(
+          '%.6f' % getattr(self, c)[i] for c in self.columns)))
+
+# VirtualClock replaces the real clock for simulated runs: sleep() just
+# advances the time, so a whole timelapse plays out in moments with the
+# same deadlines, pin transitions and accounting as a real one.
+
+class VirtualClock:
+
+    def __init__(self, start=0.0):
+      self.t = start
+
+    def now(self):
+      return self.t
+
+    def sleep(self, seconds):
+      if seconds > 0: self.t += seconds
+
+# FrameLog writes one JSON line per captured frame: the planned and
+# actual offsets from the start of the run of each edge (travel start
+# and stop, focus, shutter open and close, pause end), the wall clock
+# time the shutter opened, for matching against EXIF times, and the
+# drift at the end of the frame.  The capture thread only queues the
+# record; a background thread writes, flushes when the queue drains and
+# rotates the file at maxBytes keeping 'backups' old files.
+
+class FrameLog:
+
+    def __init__(self, path, maxBytes=1024*1024, backups=3):
+      self.path     = path
+      self.maxBytes = maxBytes
+      self.backups  = backups
+      self.records  = Queue.Queue()
+      self.writer   = None
+      self.out      = None
+
+    def record(self, rec):        # called from the capture thread
+      if self.writer is None:
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+      self.records.put(rec)
+
+    def close(self):              # write what's queued and stop the writer
+      if self.writer:
+        self.records.put(None)
+        self.writer.join()
+        self.writer = None
+
+    def run(self):
+      while True:
+        rec = self.records.get()
+        if rec is None:
+          if self.out: self.out.close()
+          self.out = None
+          self.records.task_done()
+          return
+        try:
+          if self.out is None:
+            self.out = open(self.path, 'ab')
+          self.out.write(json.dumps(rec, sort_keys=True) + '\n')
+          if self.records.empty():
+            self.out.flush()
+          if self.out.tell() >= self.maxBytes:
+            self.rotate()
+        except (IOError, OSError), e:
+          print 'Frame log: %s' % e
+        finally:
+          self.records.task_done()
+
+    def rotate(self):             # path -> path.1 -> ... -> path.<backups>
+      self.out.close()
+      self.out = None
+      for n in range(self.backups - 1, 0, -1):
+        older = '%s.%d' % (self.path, n)
+        if os.path.exists(older):
+          os.rename(older, '%s.%d' % (self.path, n + 1))
+      os.rename(self.path, self.path + '.1')
+
+# ScaledClock runs real sleeps 'factor' times faster than the plan asks,
+# so a long plan exercises the real OS timers in a few seconds.  Errors
+# measured against it are divided by factor to get real seconds.
+
+class ScaledClock:
+
+    def __init__(self, factor):
+      self.factor = factor
+      self.origin = monotonic()
+
+    def now(self):
+      return (monotonic() - self.origin) * self.factor
+
+    def sleep(self, seconds):
+      if seconds > 0: time.sleep(seconds / self.factor)
+
+# Scheduler paces the timelapse against absolute deadlines.  Every phase
+# of every frame is given as an offset from the single start time taken
+# by begin(), so time lost to GPIO writes, Python overhead or a late
+# wakeup in one phase is absorbed by the next sleep instead of pushing
+# out every following frame.  How late each phase ended is recorded.
+#
+# Waits block in select() on a pipe rather than in time.sleep, so stop(),
+# pause() and resume() from the UI thread wake the capture thread within
+# milliseconds however long the phase (Python 2's Event.wait polls with
+# up to 50ms naps).  While paused the motors driven in the current
+# phase are stopped and the remaining deadlines move out by the time
+# spent paused.  Focus and shutter aren't pausable: a pause pressed with
+# the shutter open takes effect once it closes, so the exposure isn't
+# stretched by the time spent paused.
+#
+# A sleep overshoots its timeout by the kernel's wakeup latency.  That
+# overshoot is measured on every wait and kept per phase as a moving
+# average ('lead', capped at maxLead); each wait asks to wake that much
+# early and spins out the last stretch to the deadline.
+
+class Scheduler:
+
+    def __init__(self, clock=monotonic, sleep=None, factor=1.0):
+      self.clock    = clock
+      self.sleep    = sleep or self.wait
+      self.factor   = factor  # clock seconds per real second (ScaledClock)
+      self.start    = clock() # until begin(), so elapsed() works for manual moves
+      self.planned  = 0.0   # Offset of the last deadline reached
+      self.late     = 0.0   # How late that deadline was reached
+      self.lateness = {}    # phase -> [count, total, worst] seconds late
+      self.lead     = {}    # phase -> expected sleep overshoot, seconds
+      self.maxLead  = 0.01 * factor
+      self.stopping = False
+      self.paused   = False
+      self.wakeR, self.wakeW = os.pipe()
+
+    def arm(self):                # clear any stop/pause before a new run
+      self.stopping = False
+      self.paused   = False
+
+    def begin(self):
+      self.start    = self.clock()
+      self.planned  = 0.0
+      self.late     = 0.0
+      self.lateness = {}
+
+    def elapsed(self):
+      return self.clock() - self.start
+
+    def wait(self, timeout=None): # sleep until timeout or a wake(), True if woken
+      try:
+        ready = select.select([self.wakeR], [], [], timeout)[0]
+      except select.error, e:
+        if e.args[0] != errno.EINTR: raise
+        return False              # a signal; caller re-checks its deadline
+      if ready:
+        os.read(self.wakeR, 512)
+      return bool(ready)
+
+    def wake(self):
+      os.write(self.wakeW, 'x')
+
+    def stop(self):
+      self.stopping = True
+      self.wake()
+
+    def pause(self):
+      self.paused = True
+      self.wake()
+
+    def resume(self):
+      self.paused = False
+      self.wake()
+
+    def sleepUntil(self, offset, phase, drivers=(), pausable=True):
+      # Returns False if the timelapse was stopped before the deadline.
+      # drivers are the motors that may be running through this phase.
+      # A pause asked for in a phase that isn't pausable waits for the
+      # next phase that is.
+      while not self.stopping:
+        if self.paused and pausable:
+          for driver in drivers: driver.hold()
+          pausedAt = self.clock()
+          while self.paused and not self.stopping:
+            self.wait()
+          self.start += self.clock() - pausedAt
+          if self.stopping: break
+          for driver in drivers: driver.release()
+          continue
+        lead = self.lead.get(phase, 0.0)
+        wakeAt = self.start + offset - lead
+        remaining = wakeAt - self.clock()
+        if remaining <= 0: break
+        if not self.sleep(remaining):
+          over = self.clock() - wakeAt
+          self.lead[phase] = min(self.maxLead, max(0.0, 0.8 * lead + 0.2 * over))
+      while not self.stopping and self.clock() < self.start + offset:
+        pass                      # at most 'lead' early, spin to the deadline
+      if self.stopping: return False
+      late = self.clock() - (self.start + offset)
+      self.planned = offset
+      self.late    = late
+      stats = self.lateness.setdefault(phase, [0, 0.0, 0.0])
+      stats[0] += 1
+      stats[1] += late
+      stats[2]  = max(stats[2], late)
+      return True
+
+    def drift(self):              # actual minus planned time at the last deadline
+      return self.late
+
+    def report(self):             # lateness in real milliseconds
+      scale = 1000.0 / self.factor
+      print "Timelapse drift %.4fs after %.1fs" % (self.drift() / self.factor, self.planned)
+      for phase in sorted(self.lateness):
+        count, total, worst = self.lateness[phase]
+        print "  %-9s %4d waits, mean %.2fms late, worst %.2fms, lead %.2fms" % (
+          phase, count, scale * total / count, scale * worst,
+          scale * self.lead.get(phase, 0.0))
+
+# Pin backends -------------------------------------------------------------
+
+# SysfsPin drives a pin through /sys/class/gpio.  The value file is
+# opened once and each write is a single write() on that descriptor,
+# rather than forking a shell to echo into it.
+
+class SysfsPin:
+
+    def __init__(self, pin, root='/sys/class/gpio'):
+      self.pin  = pin
+      self.path = '%s/gpio%d' % (root, pin)
+      if not os.path.exists(self.path):
+        self.put(root + '/export', str(pin))
+      self.put(self.path + '/direction', 'out')
+      self.fd   = os.open(self.path + '/value', os.O_WRONLY)
+
+    def put(self, path, text):
+      fd = os.open(path, os.O_WRONLY)
+      try:
+        os.write(fd, text)
+      finally:
+        os.close(fd)
+
+    def write(self, state):
+      os.write(self.fd, '1' if state else '0')
+
+    def close(self):
+      os.close(self.fd)
+
+def benchBacklight(n=50):         # compare backlight toggle cost, shell vs SysfsPin
+    path = '/sys/class/gpio/gpio%d/value' % backlightpin
+    pin = SysfsPin(backlightpin)
+    start = monotonic()
+    for i in range(n):
+        os.system("echo '%d' > %s" % (i & 1, path))
+    shell = (monotonic() - start) / n
+    start = monotonic()
+    for i in range(n):
+        pin.write(i & 1)
+    direct = (monotonic() - start) / n
+    pin.write(1)
+    pin.close()
+    print "Backlight toggle: shell %.3fms, sysfs fd %.3fms (%.0fx)" % (
+        1000.0 * shell, 1000.0 * direct, shell / max(direct, 1e-9))
+
+# All motor, shutter, focus, LED and backlight output goes through the
+# global 'gpio' backend.  A backend offers the wiringpi2.GPIO calls used
+# here (pinMode, digitalWrite and the HIGH/LOW/INPUT/OUTPUT constants),
+# wiringpi's software PWM for the motor ramps, plus the backlight, which
+# isn't reachable through wiringpi.
+# PISLIDE_BACKEND=sim in the environment selects the simulated backend;
+# without it a missing wiringpi2 stops the controller at startup.
+
+class WiringPiBackend:
+
+    def __init__(self):
+      self.gpio   = wiringpi2.GPIO(wiringpi2.GPIO.WPI_MODE_GPIO)
+      self.HIGH   = self.gpio.HIGH
+      self.LOW    = self.gpio.LOW
+      self.INPUT  = self.gpio.INPUT
+      self.OUTPUT = self.gpio.OUTPUT
+
+    def pinMode(self, pin, mode):
+      self.gpio.pinMode(pin, mode)
+
+    def digitalWrite(self, pin, value):
+      self.gpio.digitalWrite(pin, value)
+
+    def exportBacklight(self):
+      # I couldnt seem to get at pin 252 for the backlight using wiringpi,
+      # but the sysfs interface works
+      self.backlight = SysfsPin(backlightpin)
+
+    def setBacklight(self, state):
+      self.backlight.write(state)
+
+    def softPwmCreate(self, pin, value, range):
+      wiringpi2.softPwmCreate(pin, value, range)
+
+    def softPwmWrite(self, pin, value):
+      wiringpi2.softPwmWrite(pin, value)
+
+# SimulatedBackend stands in for the Pi's pins on any machine.  Every
+# level change is timestamped with 'clock' into a ring buffer of the
+# most recent 'size' transitions (time, pin, value), so a run's exact
+# pulse train can be inspected or measured afterwards.  Software PWM
+# duty changes go to a second ring buffer, 'duty', as (time, pin, duty);
+# a pin reads HIGH while its duty is above zero.
+
+class SimulatedBackend:
+
+    HIGH   = 1
+    LOW    = 0
+    INPUT  = 0
+    OUTPUT = 1
+
+    def __init__(self, clock=monotonic, size=65536):
+      self.clock       = clock
+      self.transitions = deque(maxlen=size)
+      self.duty        = deque(maxlen=size)
+      self.levels      = {} # pin -> current level
+      self.modes       = {} # pin -> current mode
+      self.ranges      = {} # pin -> soft PWM range
+
+    def pinMode(self, pin, mode):
+      self.modes[pin] = mode
+
+    def digitalWrite(self, pin, value):
+      if self.levels.get(pin) != value:
+        self.levels[pin] = value
+        self.transitions.append((self.clock(), pin, value))
+
+    def softPwmCreate(self, pin, value, range):
+      self.ranges[pin] = range
+      self.softPwmWrite(pin, value)
+
+    def softPwmWrite(self, pin, value):
+      self.duty.append((self.clock(), pin, value))
+      self.digitalWrite(pin, self.HIGH if value > 0 else self.LOW)
+
+    def exportBacklight(self):
+      self.pinMode(backlightpin, self.OUTPUT)
+
+    def setBacklight(self, state):
+      self.digitalWrite(backlightpin, state)
+
+    def pulses(self, pin):        # [(rise, fall)] for each completed HIGH pulse
+      found = []
+      rise = None
+      for when, p, value in self.transitions:
+        if p != pin: continue
+        if value == self.HIGH: rise = when
+        elif rise is not None:
+          found.append((rise, when))
+          rise = None
+      return found
+
+def makeBackend():
+    if os.environ.get('PISLIDE_BACKEND') == 'sim':
+        return SimulatedBackend()
+    if wiringpi2 is None:         # never run a timelapse blind to the pins
+        raise ImportError('wiringpi2 is not installed; '
+                          'PISLIDE_BACKEND=sim runs on simulated GPIO')
+    return WiringPiBackend()
+
+# Motor --------------------------------------------------------------------
+
+# MotionProfile is the shape of the whole move: keyframes of [frame,
+# position], both as fractions of the run (frame 0 the first image, 1 the
+# last; position 0 the start, 1 the full Distance or PanEnd), joined by
+# segments eased by 'ease', 0 for straight lines through to 1 for a full
+# smoothstep ease in and out of every keyframe.  positions() evaluates
+# every frame at once, with numpy when it's installed, so the capture
+# thread only ever reads the finished plan.
+
+class MotionProfile:
+
+    def __init__(self, keyframes, ease=0.0):
+      self.frames    = [float(f) for f, p in keyframes]
+      self.positions = [float(p) for f, p in keyframes]
+      self.ease      = float(ease)
+
+    def evaluate(self, n):        # position of each of n frames
+      if numpy is not None:
+        t  = numpy.linspace(0.0, 1.0, n)
+        f  = numpy.array(self.frames)
+        p  = numpy.array(self.positions)
+        k  = numpy.clip(numpy.searchsorted(f, t, 'right') - 1, 0, len(f) - 2)
+        u  = (t - f[k]) / (f[k + 1] - f[k])
+        u += self.ease * (u * u * (3 - 2 * u) - u)
+        return p[k] + (p[k + 1] - p[k]) * u
+      found = array('d')
+      k = 0
+      for i in range(n):
+        t = i / float(max(n - 1, 1))
+        while k < len(self.frames) - 2 and t >= self.frames[k + 1]: k += 1
+        u = (t - self.frames[k]) / (self.frames[k + 1] - self.frames[k])
+        u += self.ease * (u * u * (3 - 2 * u) - u)
+        found.append(self.positions[k] + (self.positions[k + 1] - self.positions[k]) * u)
+      return found
+
+    def displacements(self, n):   # move before each of n frames, none before the first
+      at = self.evaluate(n)
+      if numpy is not None:
+        return [0.0] + numpy.diff(at).tolist()
+      return [0.0] + [at[i] - at[i - 1] for i in range(1, n)]
+
+# MotorDriver owns a pair of DC motor pins, one per direction: 'motor'
+# the slide, 'head' the rotation head.  With no ramp a move is the
+# original full-on pulse through digitalWrite.  With a ramp the pins run
+# on wiringpi's software PWM: the duty climbs to full over 'ramp' seconds
+# in steps of about 50ms, holds, and falls back the same way.  Taking the
+# slide speed as proportional to duty, a linear ramp costs half its
+# length in distance at each end, so a ramped move is lengthened by the
+# ramp time to cover the same ground.  Each step is written at the
+# midpoint duty of its slice, so the steps cover exactly the distance of
+# the linear ramp.
+#
+# A move is given as a list of timed events, (offset, phase, function,
+# args), so moves of several axes can be merged and run together by
+# runMoves on the scheduler.
+
+class MotorDriver:
+
+    range = 100                   # soft PWM range, 100 steps of 100us
+
+    def __init__(self, pinA, pinB, step=0.05):
+      self.pins    = (pinA, pinB)
+      self.step    = step         # seconds between duty changes in a ramp
+      self.pwm     = False        # pins set up for soft PWM
+      self.current = {}           # pin -> duty last written
+      self.began   = 0.0          # when the last move started
+      self.ran     = 0.0          # seconds the last move actually ran
+
+    def usePwm(self):             # move the pins to soft PWM, once
+      if self.pwm: return
+      for pin in self.pins:
+        gpio.softPwmCreate(pin, 0, self.range)
+      self.pwm = True
+
+    def put(self, pin, duty):
+      if self.pwm: gpio.softPwmWrite(pin, duty)
+      else:        gpio.digitalWrite(pin, gpio.HIGH if duty else gpio.LOW)
+
+    def write(self, pin, duty):
+      # timed on the run's elapsed clock so time spent paused isn't counted
+      if duty and not self.current.get(pin):
+        self.began = scheduler.elapsed()
+      elif not duty and self.current.get(pin):
+        self.ran = scheduler.elapsed() - self.began
+      self.current[pin] = duty
+      self.put(pin, duty)
+
+    def run(self, pin):           # full on, no ramp (manual moves)
+      self.write(pin, self.range)
+
+    def stop(self):
+      for pin in self.pins:
+        self.write(pin, 0)
+
+    def hold(self):               # drop the pins while paused, keeping their duty
+      for pin in self.pins: self.put(pin, 0)
+
+    def release(self):
+      for pin in self.pins: self.put(pin, self.current.get(pin, 0))
+
+    def profile(self, ramp):      # [(offset, duty)] of the up ramp
+      if ramp <= 0: return []
+      n = max(1, int(round(ramp / self.step)))
+      return [(ramp * k / n, int(round(self.range * (k + 0.5) / n)))
+              for k in range(n)]
+
+    def events(self, pin, travel, ramp):
+      # Drive pin for 'travel' seconds, ramping over 'ramp' seconds at
+      # each end.
+      up = self.profile(ramp)
+      found = [(offset, 'travel', self.write, (pin, duty)) for offset, duty in up]
+      found.append((ramp, 'travel', self.write, (pin, self.range)))
+      down = travel - ramp
+      for offset, duty in reversed(up):
+        found.append((down + ramp - offset - ramp / len(up), 'travel',
+                      self.write, (pin, duty)))
+      found.append((travel, 'travel', self.write, (pin, 0)))
+      return found
+
+# StepperDriver runs a step/direction driver (A4988, DRV8825 and the
+# like) on steppin/stepdirpin, enabled by pulling stepenablepin low.
+# Each frame's move is an exact number of steps: the carriage target for
+# frame i is rounded from i * distance_between, so rounding never builds
+# up along the rail.  Steps are timed from a table of the constant
+# acceleration profile in closed form, step n at sqrt(2n/a) (D. Austin,
+# "Generate stepper-motor speed profiles in real time"), worked out once
+# by prepare() for the run's speed.  A move accelerates to 'speed',
+# cruises and decelerates symmetrically; a short move turns round at the
+# midpoint.  offsets() lays out a whole move from the table; the plan
+# keeps one per distinct step count, so the capture thread only reads
+# them.  'position' is the carriage position in steps since startup.
+# Manual moves go through jog()/halt() so position follows them too: a
+# thread steps up the same table, cruises until halted and steps back
+# down it, with time.sleep between steps as nothing else is timed then.
+
+class StepperDriver:
+
+    def __init__(self, stepsPerMm, accel):
+      self.stepsPerMm = stepsPerMm
+      self.accel      = accel       # mm/s/s
+      self.position   = 0           # steps, positive with stepdirpin HIGH
+      self.times      = array('d')  # offset of each accelerating step
+      self.gaps       = array('d')  # seconds between accelerating steps
+      self.cruise     = 0.0         # seconds between steps at full speed
+      self.jogger     = None        # thread of a manual move
+      self.jogging    = False
+
+    def prepare(self, speed):       # timing table for a move at speed mm/s
+      a = float(self.accel * self.stepsPerMm)   # steps/s/s
+      v = float(speed * self.stepsPerMm)        # steps/s
+      n = int(v * v / (2 * a))      # steps taken to reach full speed
+      self.times  = array('d', [math.sqrt(2 * i / a) for i in range(n + 2)])
+      self.gaps   = array('d', [self.times[i + 1] - self.times[i]
+                                for i in range(n + 1)])
+      self.cruise = 1.0 / v
+
+    def gap(self, j, n):            # seconds from step j to the next of n
+      k = min(len(self.gaps) - 1, n // 2)
+      if j < k:      return self.gaps[j]
+      if j >= n - k: return self.gaps[n - 1 - j]
+      if k == len(self.gaps) - 1: return self.cruise
+      return self.gaps[k]
+
+    def duration(self, n):          # seconds for a move of n steps
+      k = min(len(self.gaps) - 1, n // 2)
+      if n <= 2 * k: return 2 * self.times[k]
+      return 2 * self.times[k] + (n - 2 * k) * self.gap(k, n)
+
+    def steps(self, mm):            # steps from home to mm, to the nearest
+      return int(round(mm * self.stepsPerMm))
+
+    def enable(self, on):
+      gpio.digitalWrite(stepenablepin, gpio.LOW if on else gpio.HIGH)
+
+    def direction(self, forward):
+      gpio.digitalWrite(stepdirpin, gpio.HIGH if forward else gpio.LOW)
+
+    def pulse(self, forward):
+      gpio.digitalWrite(steppin, gpio.HIGH)
+      gpio.digitalWrite(steppin, gpio.LOW)
+      self.position += 1 if forward else -1
+
+    def jog(self, forward):         # manual move until halt()
+      self.halt()
+      self.jogging = True
+      self.jogger  = threading.Thread(target=self.runJog, args=(forward,))
+      self.jogger.daemon = True
+      self.jogger.start()
+
+    def halt(self):                 # end a manual move, once it has slowed down
+      if self.jogger is None: return
+      self.jogging = False
+      self.jogger.join()
+      self.jogger = None
+
+    def runJog(self, forward):
+      self.enable(True)
+      self.direction(forward)
+      j = 0
+      while self.jogging:
+        self.pulse(forward)
+        time.sleep(self.gaps[j] if j < len(self.gaps) else self.cruise)
+        j += 1
+      for k in reversed(range(min(j, len(self.gaps)))):
+        self.pulse(forward)
+        time.sleep(self.gaps[k])
+      self.enable(False)
+
+    def offsets(self, n):           # offset of each of n steps from the first
+      found = array('d')
+      at = 0.0
+      for j in range(n):
+        found.append(at)
+        at += self.gap(j, n)
+      return found
+
+def runMoves(start, travel, events, drivers=(), steps=(), forward=True,
+             pausable=True):
+    # Run the move events of the DC axes and the stepper's step offsets
+    # ('steps', from the plan) in time order from offset 'start' on the
+    # scheduler, then wait out the 'travel' seconds of the phase.  The DC
+    # drivers are held while paused.  Steps are timed from the moment the
+    # first one is taken, and a later step reached more than a quarter of
+    # its gap late pushes the rest back by the excess, so lateness moves
+    # the step profile instead of bunching steps into a burst the motor
+    # can't follow.  A stepper can't pick up again at the step rate it was
+    # stopped at either, so a move with steps isn't pausable and the pause
+    # waits for it to end.  Returns False if the timelapse was stopped
+    # part way.
+    events.sort(key=lambda e: e[0])
+    if steps: stepper.direction(forward)
+    k = 0                         # next DC event
+    j = 0                         # next step
+    late = 0.0                    # how far the step profile has been pushed back
+    while k < len(events) or j < len(steps):
+      if j < len(steps) and (k == len(events) or steps[j] + late <= events[k][0]):
+        if not scheduler.sleepUntil(start + steps[j] + late, 'step', drivers, pausable):
+          return False
+        stepper.pulse(forward)
+        over = scheduler.elapsed() - (start + steps[j] + late)  # as taken
+        if j == 0:
+          late += over
+        elif j + 1 < len(steps):
+          late += max(0.0, over - 0.25 * (steps[j + 1] - steps[j]))
+        j += 1
+      else:
+        offset, phase, function, args = events[k]
+        if not scheduler.sleepUntil(start + offset, phase, drivers, pausable):
+          return False
+        function(*args)
+        k += 1
+    return scheduler.sleepUntil(start + travel, 'travel', drivers, pausable)
+
+# Settings -----------------------------------------------------------------
+
+# SettingsStore keeps the current settings and any named presets in one
+# JSON file, wrapped with a schema version and a checksum of the payload.
+# A save goes to a temporary file that is fsync'd and renamed over the
+# old one, so a power cut leaves either the old or the new file intact,
+# and nothing is written when the values haven't changed (SD card wear).
+
+class SettingsStore:
+
+    version = 1
+
+    def __init__(self, path, legacy=None):
+      self.path    = path
+      self.legacy  = legacy # old cPickle file to migrate from, if any
+      self.current = {}
+      self.presets = {}     # name -> settings dict
+      self.saved   = None   # payload text as last read or written
+
+    def payload(self):
+      return json.dumps({'current': self.current, 'presets': self.presets},
+                        sort_keys=True)
+
+    def load(self):               # True if settings were read
+      try:
+        infile = open(self.path, 'rb')
+      except IOError, e:
+        if e.errno != errno.ENOENT: print 'Settings: %s' % e
+        return self.migrate()
+      try:
+        record = json.load(infile)
+      except ValueError, e:
+        return self.reject('unreadable (%s)' % e)
+      finally:
+        infile.close()
+      if not isinstance(record, dict):
+        return self.reject('is not a settings record')
+      if record.get('version') != self.version:
+        return self.reject('has version %s, expected %d' % (
+          record.get('version'), self.version))
+      text = record.get('payload', '')
+      if not isinstance(text, basestring) or \
+         record.get('checksum') != hashlib.sha1(text.encode('utf-8')).hexdigest():
+        return self.reject('checksum mismatch')
+      try:
+        payload = json.loads(text)
+      except ValueError, e:
+        return self.reject('payload unreadable (%s)' % e)
+      if not isinstance(payload, dict):
+        return self.reject('payload is not a settings record')
+      self.current = payload.get('current', {})
+      self.presets = payload.get('presets', {})
+      self.saved   = self.payload()
+      return True
+
+    def reject(self, reason):     # move a bad file aside so save can't lose it
+      print 'Settings: %s %s' % (self.path, reason)
+      try:
+        os.rename(self.path, self.path + '.bad')
+        print 'Settings: kept as %s.bad' % self.path
+      except OSError, e:
+        print 'Settings: %s' % e
+      return False
+
+    def migrate(self):            # read the old pickle once, if present
+      if not self.legacy or not os.path.exists(self.legacy): return False
+      try:
+        infile = open(self.legacy, 'rb')
+        try:
+          self.current = pickle.load(infile)
+        finally:
+          infile.close()
+      except Exception, e:
+        print 'Settings: %s unreadable (%s)' % (self.legacy, e)
+        return False
+      print 'Settings: migrated ' + self.legacy
+      return True
+
+    def save(self):               # True if the file was (re)written
+      text = self.payload()
+      if text == self.saved: return False
+      record = json.dumps({'version': self.version,
+                           'checksum': hashlib.sha1(text).hexdigest(),
+                           'payload': text})
+      temp = self.path + '.tmp'
+      try:
+        outfile = open(temp, 'wb')
+        try:
+          outfile.write(record)
+          outfile.flush()
+          os.fsync(outfile.fileno())
+        finally:
+          outfile.close()
+        os.rename(temp, self.path)
+        folder = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+          os.fsync(folder)        # make the rename itself durable
+        finally:
+          os.close(folder)
+      except (IOError, OSError), e:
+        print 'Settings: save failed (%s)' % e
+        return False
+      self.saved = text
+      return True
 
 # UI callbacks -------------------------------------------------------------
 # These are defined before globals because they're referenced by items in
@@ -129,17 +1186,15 @@ def backlightCallback(n):         # toggle the screen backlight on and off
     if backlightState==0:
         # enable the backlight, critical for night timelapses, also saves power
         backlightState=1
-        os.system("echo '1' > /sys/class/gpio/gpio252/value")
     else:
         # disable the backlight, critical for night timelapses, also saves power
         backlightState=0
-        os.system("echo '0' > /sys/class/gpio/gpio252/value")
+    gpio.setBacklight(backlightState)
 
 def gpioCleanup():
     print 'GPIO Clean up'
-    gpio.digitalWrite(motorpin,gpio.LOW)
-    gpio.digitalWrite(motorpinA,gpio.LOW)
-    gpio.digitalWrite(motorpinB,gpio.LOW)
+    motor.stop()
+    head.stop()
     gpio.digitalWrite(shutterpin,gpio.LOW)
     gpio.digitalWrite(focuspin,gpio.LOW)
     gpio.digitalWrite(wshutterpin,gpio.LOW)
@@ -147,6 +1202,8 @@ def gpioCleanup():
     gpio.digitalWrite(redpin,gpio.LOW)
     gpio.digitalWrite(greenpin,gpio.LOW)
     gpio.digitalWrite(bluepin,gpio.LOW)
+    stepper.halt()
+    stepper.enable(False)
 
     gpio.pinMode(shutterpin,gpio.INPUT)
     gpio.pinMode(focuspin,gpio.INPUT)
@@ -155,10 +1212,24 @@ def gpioCleanup():
     gpio.pinMode(motorpin,gpio.INPUT)
     gpio.pinMode(motorpinA,gpio.INPUT)
     gpio.pinMode(motorpinB,gpio.INPUT)
+    gpio.pinMode(rotatepinA,gpio.INPUT)
+    gpio.pinMode(rotatepinB,gpio.INPUT)
+    gpio.pinMode(steppin,gpio.INPUT)
+    gpio.pinMode(stepdirpin,gpio.INPUT)
+    gpio.pinMode(stepenablepin,gpio.INPUT)
     gpio.pinMode(redpin,gpio.INPUT)
     gpio.pinMode(greenpin,gpio.INPUT)
     gpio.pinMode(bluepin,gpio.INPUT)
 
+def safePins():                   # motor off, shutter and focus released
+    motor.stop()
+    head.stop()
+    stepper.enable(False)
+    gpio.digitalWrite(shutterpin,gpio.LOW)
+    gpio.digitalWrite(focuspin,gpio.LOW)
+    gpio.digitalWrite(wshutterpin,gpio.LOW)
+    gpio.digitalWrite(wfocuspin,gpio.LOW)
+
 def shutdownPi(n):                # return to primary or shutdown Pi
     global screenMode
     print 'shutdownPi=' + str(n)
@@ -171,14 +1242,13 @@ def shutdownPi(n):                # return to primary or shutdown Pi
             ((320 - img.get_width() ) / 2,
             (240 - img.get_height()) / 2))
                 
-        myfont = pygame.font.SysFont("Arial", smallfont)
-        myfont.set_bold(False)
+        myfont = getFont(smallfont)
         msgString = 'Turn Power Off In 10 Seconds'
         label = myfont.render(msgString, 1, (whitefont))
         screen.blit(label, (xPos(msgString,2,screenMode,myfont), 90))
         pygame.display.update()
         time.sleep(5)
-        gpioCleanup
+        gpioCleanup()
 
 	# shutdown the Raspberry Pi
     #   sys.exit()
@@ -186,6 +1256,19 @@ def shutdownPi(n):                # return to primary or shutdown Pi
         time.sleep(10)
     
     
+def jog(pin):                     # manual move towards pin's end of the slide
+    if busy: return               # the timelapse owns the motors
+    if int(v['Motor']) == 1:
+        stepper.prepare(float(v['Speed']))
+        stepper.jog(pin == motorpinA)
+    else:
+        motor.run(pin)
+
+def jogStop():
+    if busy: return               # leave the capture thread's duty alone
+    stepper.halt()
+    motor.stop()
+
 def motorCallback(n):             # set the motor direction and run the motor
     global screenMode
     global motorRunning
@@ -205,27 +1288,24 @@ def motorCallback(n):             # set the motor direction and run the motor
         motorpin = motorpinA
         if motorRunning == 0:
             motorRunning = 1
-            gpio.digitalWrite(motorpin,gpio.HIGH)
+            jog(motorpin)
         else:
             motorRunning = 0
-            gpio.digitalWrite(motorpinA,gpio.LOW)
-            gpio.digitalWrite(motorpinB,gpio.LOW)
+            jogStop()
     elif n == 2:
         motorDirectionPrior = motorDirection
         motorDirection = 0
         motorpin = motorpinB
         if motorRunning == 0:
             motorRunning = 1
-            gpio.digitalWrite(motorpin,gpio.HIGH)
+            jog(motorpin)
         else:
             motorRunning = 0
-            gpio.digitalWrite(motorpinA,gpio.LOW)
-            gpio.digitalWrite(motorpinB,gpio.LOW)
+            jogStop()
     elif n == 3:
         if motorRunning == 1:
             motorRunning = 0
-            gpio.digitalWrite(motorpinA,gpio.LOW)
-            gpio.digitalWrite(motorpinB,gpio.LOW)
+            jogStop()
         if motorDirection == 0:
             motorDirectionPrior = motorDirection
             motorDirection = 1
@@ -327,6 +1407,43 @@ def valuesCallback(n):            # select a parameter and goto keypad (-1 retur
         screenMode = 2
         returnScreen = 1
 
+def presetCallback(n):            # preset picker: -2 open, -1 return, 0 save mode, 1+ slot
+    global screenMode
+    global presetSaving
+    global presetMessage
+
+    if n == -2:
+        screenMode = 5
+        presetSaving = False
+        presetMessage = ''
+    elif n == -1:
+        screenMode = 0
+    elif n == 0:
+        presetSaving = not presetSaving
+        if presetSaving: presetMessage = 'Tap a slot to save'
+        else:            presetMessage = ''
+    else:
+        name = presetSlots[n - 1]
+        if presetSaving:
+            store.presets[name] = dict(v)
+            saveSettings()
+            presetSaving = False
+            presetMessage = 'Saved ' + name
+        elif busy:
+            presetMessage = 'Stop the timelapse first'
+        elif name not in store.presets:
+            presetMessage = name + ' is empty'
+        else:
+            v.update(store.presets[name])
+            reasonableValues()
+            if timelapseSettings():
+                presetMessage = 'Invalid timing-Update Parms'
+            else:
+                presetMessage = 'Pause %ds' % round(pause_time, 0)
+            saveSettings()
+    for b in buttons[5]:            # show which mode the picker is in
+        if b.value == 0: b.setLabel(('Save', 'Saving')[presetSaving])
+
 def viewCallback(n):              # Set branch to parameters screen (screen 1)
     global screenMode, screenModePrior
     if n is 0:   # Gear icon
@@ -338,19 +1455,30 @@ def viewCallback(n):              # Set branch to parameters screen (screen 1)
 #      saveSettings()
 #    screenMode = 0                # Switch back to main window
 
-def startCallback(n):             # start/Stop the timelapse thread
+def startCallback(n):             # start/pause/resume/Stop the timelapse thread
     # threadExited - initiated as False
     #              - set to True in timelapse when image count exhausted
     #              - set to False here when starting a thread
     # busy - initiated as False
     #      - set to False here when explicitly ending the thread with keypad 'Stop'
     #      - set to True at start of timelapse, False at completion
+    # Start while the timelapse is running toggles pause/resume.
     global t, busy, threadExited
     global currentframe
     global consumed_time
+    global task_indicator
     global doneNotify
+    global stop_latency
     
     if n == 1:
+        if busy == True:
+            if scheduler.paused:
+                scheduler.resume()
+                setLED("running")
+            else:
+                scheduler.pause()
+                setLED("cyan")
+            return
     #    print 'setLED 4'
         setLED("running")
         if busy == False:
@@ -358,15 +1486,22 @@ def startCallback(n):             # start/Stop the timelapse thread
                 # Re-instanciate the object for the next start
                 t = threading.Thread(target=timeLapse)
                 threadExited = False
+            scheduler.arm()
+            busy = True           # before start() so an immediate Stop is honoured
             t.start()
     if n == 0:
         if busy == True:
+            stopped = monotonic()
             busy = False
+            scheduler.stop()
+            safePins()            # don't wait on the thread to release the rig
             t.join()
+            stop_latency = monotonic() - stopped
+            print "Stop took %.1fms" % (1000.0 * stop_latency)
             currentframe = 0
             consumed_time = 0
             task_indicator  = "done"
-            doneNotify = time.time() + (30 * 1) # set done LED show delay
+            doneNotify = now() + (30 * 1) # set done LED show delay
             # Re-instanciate the object for the next time around.
             t = threading.Thread(target=timeLapse)
 
@@ -399,80 +1534,146 @@ def timeLapse():                  # execute the timelapse (separate thread)
     global task_indicator
     global doneNotify
 
-    # set copies of the following to isolate operation from setup
-    # images, motorpin
-    # travelpulse, focus_pause, shutter_time, pause_time
-    
+    # replay the plan as it stood at start, isolated from later setup changes
+    p = plan
+    if any(p.ramp): motor.usePwm()
+    if any(p.steps): stepper.enable(True)
+
     busy = True
-    
+
+    # every phase ends at a deadline measured from one start time; 'at' is
+    # the planned offset of the current deadline
+    scheduler.begin()
+    carry = 0.0                   # slide motor seconds run beyond the plan, signed
+    moves = 0
+    panCarry = 0.0                # head seconds run beyond the plan, signed
+    turns = 0
+
     # multitude of breaks to give fastest time out of loop
-    for i in range( 1 , v['Images'] + 1 ):
-        this_time = 0.0
+    for i in range(len(p)):
         if busy == False:
             break
+        at = p.start[i]
+        rec = {'frame': i + 1}    # [planned, actual] offset of each edge
 
-        # move slide forward on all but first image
-        if i!=1:
+        # move slide forward and turn the head on all but first image; the
+        # axes start together and the phase lasts as long as the longest
+        if p.travel[i]:
             task_indicator = "travel"
-            gpio.digitalWrite(motorpin,gpio.HIGH)
-            time.sleep(travel_pulse)
-            gpio.digitalWrite(motorpin,gpio.LOW)
-            this_time = this_time + travel_pulse
-            if busy == False:
+            notifyUI()
+            rec['travel_start'] = [at, scheduler.elapsed()]
+            events = []
+            # a negative move runs the other way
+            steps = p.stepTimes.get(int(abs(p.steps[i])), ())
+            forward = (motorpin == motorpinA) == (p.steps[i] > 0)
+            # each DC motor's running time so far, over or under the plan,
+            # comes off this move so the total travel tracks the plan
+            if p.slide[i]:
+                slide = p.slide[i] - carry
+                back = motorpinB if motorpin == motorpinA else motorpinA
+                events += motor.events(motorpin if slide > 0 else back,
+                                       max(abs(slide), 2 * p.ramp[i]), p.ramp[i])
+            if p.pan[i]:
+                turn = p.pan[i] - panCarry
+                events += head.events(rotatepinA if turn > 0 else rotatepinB,
+                                      abs(turn), 0.0)
+            if not runMoves(at, p.travel[i], events, (motor, head),
+                            steps, forward, pausable=not p.steps[i]):
                 break
+            if p.slide[i]:
+                carry += math.copysign(motor.ran, slide) - p.slide[i]
+                moves += 1
+            if p.pan[i]:
+                panCarry += math.copysign(head.ran, turn) - p.pan[i]
+                turns += 1
+            at += p.travel[i]
+            rec['travel_stop'] = [at, scheduler.elapsed()]
+            if p.steps[i]:
+                rec['position'] = float(stepper.position) / steps_per_mm
     
         task_indicator = "settling"
-        time.sleep(settling_time)
-        this_time = this_time + settling_time
-
-        if busy == False:
+        notifyUI()
+        at += p.settle[i]
+        if not scheduler.sleepUntil(at, 'settle'):
             break
             
         task_indicator = "fire"
+        notifyUI()
         # trigger the focus
         gpio.digitalWrite(focuspin,gpio.HIGH)
         gpio.digitalWrite(wfocuspin,gpio.HIGH)
-        time.sleep(focus_pause)
+        rec['focus'] = [at, scheduler.elapsed()]
+        at += p.focus[i]
+        if not scheduler.sleepUntil(at, 'focus', pausable=False):
+            break
 
         # trigger the shutter
         gpio.digitalWrite(shutterpin,gpio.HIGH)
         gpio.digitalWrite(wshutterpin,gpio.HIGH)
-        time.sleep(shutter_time)
+        rec['shutter_open'] = [at, scheduler.elapsed()]
+        rec['wall'] = now()
+        at += p.exposure[i]
+        if not scheduler.sleepUntil(at, 'shutter', pausable=False):
+            break
         gpio.digitalWrite(shutterpin,gpio.LOW)
         gpio.digitalWrite(focuspin,gpio.LOW)
         gpio.digitalWrite(wshutterpin,gpio.LOW)
         gpio.digitalWrite(wfocuspin,gpio.LOW)
-
-        currentframe = i
-        consumed_time = consumed_time + shutter_time + focus_pause + this_time
-        
-        if busy == False:
+        rec['shutter_close'] = [at, scheduler.elapsed()]
+
+        currentframe = i + 1
+        consumed_time = scheduler.elapsed()
+        notifyUI()
+
+        # the frame has been taken, so it's logged even if stopped in the pause
+        stopped = busy == False
+        if not stopped:
+            task_indicator = "pause"
+            notifyUI()
+            stopped = not scheduler.sleepUntil(p.end(i), 'pause')
+        if not stopped:
+            rec['pause_end'] = [p.end(i), scheduler.elapsed()]
+        rec['drift'] = scheduler.drift()
+        frameLog.record(rec)
+        if stopped:
             break
-    
-        task_indicator = "pause"
-        time.sleep(pause_time)
+
+    # a stop can break out mid-phase; leave nothing driven
+    safePins()
+    scheduler.report()
+    if moves:
+        print "Travel error %.3fmm after %d moves" % (carry * float(v['Speed']), moves)
+    if turns:
+        print "Pan error %.3f degrees after %d turns" % (panCarry * float(v['PanSpeed']), turns)
 
     currentframe = 0
     consumed_time = 0
     
-    doneNotify = time.time() + (30 * 1)  # set done LED show delay
+    doneNotify = now() + (30 * 1)  # set done LED show delay
     
     task_indicator  = "done"
     busy = False
     threadExited = True
+    notifyUI()
+
+def notifyUI():                   # wake the main loop so it repaints (called from timelapse thread)
+    try:
+        pygame.event.post(pygame.event.Event(REFRESHEVENT))
+    except pygame.error:
+        pass                      # event queue full or display gone; next touch repaints
 
 def is_integer(s):
     try:
         int(s)
         return True
-    except ValueError:
+    except (ValueError, TypeError):
         return False
 
 def is_float(s):
     try:
         float(s)
         return True
-    except ValueError:
+    except (ValueError, TypeError):
         return False
 
 def reasonableValues():
@@ -480,15 +1681,20 @@ def reasonableValues():
     global dict_idx
     global focus_pause
     if not is_float(v['Settle']):    v['Settle'] = 0
-    if not is_float(v['Shutter']):   v['Shutter'] = 1 / 60
+    if not is_float(v['Shutter']):   v['Shutter'] = 1.0 / 60
     if not is_integer(v['Images']):  v['Images'] = 10
     if not is_integer(v['Speed']):   v['Speed'] = 30
     if not is_integer(v['Distance']):v['Distance'] = 500
     if not is_integer(v['Timespan']):v['Timespan'] = 30
+    if not is_float(v['Ramp']):      v['Ramp'] = 0
+    if v['Motor'] not in (0, 1):     v['Motor'] = 0
+    if not is_float(v['PanStart']):  v['PanStart'] = 0
+    if not is_float(v['PanEnd']):    v['PanEnd'] = 0
+    if not is_float(v['PanSpeed']):  v['PanSpeed'] = 5
 
-    if    v['Shutter']==0: v['Shutter'] = 1 / 60
-    elif  v['Shutter']<(1/8000): v['Shutter'] = 1 / 60
-    elif  v['Shutter']>90: v['Shutter'] = 1 / 60
+    if    v['Shutter']==0: v['Shutter'] = 1.0 / 60
+    elif  v['Shutter']<(1.0/8000): v['Shutter'] = 1.0 / 60
+    elif  v['Shutter']>90: v['Shutter'] = 1.0 / 60
 
     if v['Images']==0 or v['Images'] > 500: v['Images'] = 10
 
@@ -501,6 +1707,52 @@ def reasonableValues():
     if    v['Timespan']<(1): v['Timespan'] = 30
     elif  v['Timespan']>1440: v['Timespan'] = 60
 
+    if    v['PanSpeed']<=0: v['PanSpeed'] = 5
+
+    if not is_float(v['Ease']) or not 0 <= v['Ease'] <= 1: v['Ease'] = 0
+    if not reasonableKeyframes(v['Keyframes']): v['Keyframes'] = [[0, 0], [1, 1]]
+
+    if not is_float(v['ShutterEnd']): v['ShutterEnd'] = 0
+    if    v['ShutterEnd']==0: pass
+    elif  v['ShutterEnd']<(1.0/8000): v['ShutterEnd'] = 0
+    elif  v['ShutterEnd']>90: v['ShutterEnd'] = 90
+    if v['Exposures'] and not reasonableExposures(v['Exposures']): v['Exposures'] = []
+    if    abs(v['PanStart'])>360: v['PanStart'] = 0
+    if    abs(v['PanEnd'])>360: v['PanEnd'] = 0
+
+    if    v['Ramp']<0: v['Ramp'] = 0
+    elif  v['Ramp']>5: v['Ramp'] = 5
+
+def reasonableKeyframes(k):       # [[frame, position], ...] from frame 0 to frame 1
+    try:
+        frames = [float(f) for f, p in k]
+        positions = [float(p) for f, p in k]
+    except (TypeError, ValueError):
+        return False
+    return (len(frames) >= 2 and frames[0] == 0 and frames[-1] == 1 and
+            all(a < b for a, b in zip(frames, frames[1:])) and
+            all(0 <= p <= 1 for p in positions))
+
+def reasonableExposures(k):       # [[frame, seconds], ...] from frame 0 to frame 1
+    try:
+        seconds = [float(e) for f, e in k]
+    except (TypeError, ValueError):
+        return False
+    return (reasonableKeyframes([[f, 0] for f, e in k]) and
+            all(1.0 / 8000 <= e <= 90 for e in seconds))
+
+def exposureSchedule(n):          # shutter seconds for each of n images
+    # Exposures, when set, is a table of [frame, seconds] with frames as
+    # fractions of the run; otherwise the exposure ramps from Shutter at
+    # the first image to ShutterEnd at the last.  Between points it
+    # changes by the same number of stops every frame, a straight line
+    # in log space.
+    if not v['Exposures'] and not v['ShutterEnd']:
+        return [float(v['Shutter'])] * n
+    table = v['Exposures'] or [[0, v['Shutter']], [1, v['ShutterEnd']]]
+    stops = MotionProfile([[f, math.log(e)] for f, e in table]).evaluate(n)
+    return [math.exp(x) for x in stops]
+
 def timelapseSettings():
     global v
     global dict_idx
@@ -512,33 +1764,94 @@ def timelapseSettings():
     global frame_interval
     global frame_duration
     global consumed_time
+    global plan
     global current_frame     #debug
 
+    images = int(v['Images'])
     settling_time = float(v['Settle'])                              # time to wait before firing shutter
-    shutter_time = float(v['Shutter'])                              # shutter speed
-    frame_time = (shutter_time + settling_time + focus_pause) 		# time for 1 image in seconds
-    shoot_time = frame_time * int(v['Images'])                      # time for all images in seconds
-    travel_time = round((float(v['Distance']) / float(v['Speed'])),1)            # total travel time for full rail in seconds
-    distance_between = round((float(v['Distance']) / (float(v['Images'])-1)),1)  # distance between shots in mm
-    travel_pulse = round(distance_between / float(v['Speed']),1)    # travel time between images in seconds
+    shutter_time = float(v['Shutter'])                              # shutter speed (first image)
+    exposure = exposureSchedule(images)                             # shutter speed of every image
+    shoot_time = sum(exposure) + (settling_time + focus_pause) * images  # time for all images in seconds
+    frame_time = shoot_time / images 		                        # mean time for 1 image in seconds
+    distance_between = float(v['Distance']) / (images - 1)         # mean distance between shots in mm
+
+    # the slide and the head both follow the keyframed motion profile; a
+    # frame moves each by the change in its position, negative moving back
+    profile = MotionProfile(v['Keyframes'], v['Ease'])
+    position = profile.evaluate(images)
+    moved = profile.displacements(images)
+
+    slide = [0.0] * images        # DC slide seconds each frame, signed
+    ramps = [0.0] * images
+    steps = [0] * images          # stepper steps each frame, signed
+    if int(v['Motor']) == 1:
+        # the stepper takes each frame to the step nearest its position,
+        # and a move lasts as long as its step profile
+        stepper.prepare(float(v['Speed']))
+        for i in range(1, images):
+            steps[i] = (stepper.steps(position[i] * float(v['Distance'])) -
+                        stepper.steps(position[i - 1] * float(v['Distance'])))
+    else:
+        # a ramped move runs longer by the ramp time to cover the same
+        # ground; a ramp longer than the move itself is cut to fit
+        for i in range(1, images):
+            seconds = abs(moved[i]) * float(v['Distance']) / float(v['Speed'])
+            ramps[i] = min(float(v['Ramp']), seconds)
+            slide[i] = math.copysign(seconds + ramps[i], moved[i])
+
+    # the rotation head turns while the slide moves, so a frame's travel
+    # lasts as long as the longer of the two moves
+    pan = [m * (float(v['PanEnd']) - float(v['PanStart'])) / float(v['PanSpeed'])
+           for m in moved]
+
+    travel = [max(abs(slide[i]), abs(pan[i]),
+                  stepper.duration(abs(steps[i])) if steps[i] else 0.0)
+              for i in range(images)]
+    travel_time = sum(travel)                                       # total travel time for full rail in seconds
+    travel_pulse = travel_time / (images - 1)
 
     # set the pause time between shots to fill defined Timespan setting
-    pause_time = (((int(v['Timespan']) * 60) - (shoot_time + travel_time)) / (int(v['Images'])-1))
-    
-    # split the pause time between pause and settling times
-    if pause_time > (settling_time * 2):
-        pause_time = (pause_time + settling_time) / 2
-        settling_time = pause_time
-        
-    frame_interval = pause_time + frame_time                        # total time to take 1 image including pause
-    frame_duration = frame_interval + travel_pulse                  # total time to take 1 image, pause and move
-    consumed_time = 0
+    pause_time = (((int(v['Timespan']) * 60) - (shoot_time + travel_time)) / (images - 1))
     
+    # each frame's pause takes up the difference in its exposure and the
+    # next frame's travel, so the shutter opens at an even interval and
+    # the last image closes at the end of the Timespan
+    interval = ((int(v['Timespan']) * 60) - (settling_time + focus_pause + exposure[-1])) / (images - 1)
+    pauses = [interval - (exposure[i] + travel[i + 1] + settling_time + focus_pause)
+              for i in range(images - 1)] + [0.0]
+
     errFound = False
-    if pause_time < 0:
+    if pause_time < 0 or min(pauses) < 0:
         errFound = True
         errmsg = "Invalid timing-Update Parms"
-        
+
+    # split the pause time between pause and settling times, evenly over
+    # the Images settles and Images-1 pauses so the Timespan still holds.
+    # Every pause gives up the same time to the settles, so with a varying
+    # exposure or travel the settle only grows as far as the shortest
+    # pause allows
+    if not errFound and pause_time > (settling_time * 2):
+        grow = (images - 1) * (pause_time - settling_time) / (2 * images - 1)
+        grow = min(grow, min(pauses[:-1]) * (images - 1) / images)
+        settling_time += grow
+        pause_time -= grow * images / (images - 1)
+        pauses = [pause - grow * images / (images - 1)
+                  for pause in pauses[:-1]] + [0.0]
+
+    frame_interval = pause_time + frame_time                        # total time to take 1 image including pause
+    frame_duration = frame_interval + travel_pulse                  # total time to take 1 image, pause and move
+    consumed_time = 0
+
+    # one row per frame for the capture thread to replay; no travel before
+    # the first frame, no pause after the last and never a negative pause
+    plan = ShotPlan()
+    for i in range(images):
+        plan.append(travel[i], settling_time, focus_pause, exposure[i],
+                    max(pauses[i], 0.0), slide=slide[i],
+                    ramp=ramps[i], steps=steps[i], pan=pan[i])
+    for count in set(abs(n) for n in steps if n):
+        plan.stepTimes[count] = stepper.offsets(count)
+
     #debug
     print "v['Shutter']....." + str(v['Shutter'])
     print "v['Timespan']...." + str(v['Timespan'])
@@ -548,15 +1861,19 @@ def timelapseSettings():
     print "v['Speed']......." + str(v['Speed'])
     print "settling_time...." + str(settling_time)
     print "shutter_time....." + str(shutter_time)
+    print "last_exposure...." + str(exposure[-1])
     print "frame_time......." + str(frame_time)
     print "shoot_time......." + str(shoot_time)
     print "travel_time......" + str(travel_time)
     print "distance_between." + str(distance_between)
     print "travel_pulse....." + str(travel_pulse)
+    print "ramp............." + str(max(ramps))
+    print "pan_travel......." + str(sum(map(abs, pan)))
     print "pause_time......." + str(pause_time)
     print "frame_interval..." + str(frame_interval)
     print "currentframe....." + str(currentframe)
-    remaining = round((float(v['Timespan']) * 60) - consumed_time,1)
+    print "plan_total......." + str(plan.total())
+    remaining = round(plan.remaining(consumed_time),1)
     print "remaining........" + str(remaining)
     sec = timedelta(seconds=int(remaining))
     print "sec.............." + str(sec)
@@ -564,10 +1881,23 @@ def timelapseSettings():
     
     return errFound
             
+def getFont(size, bold=False):    # font for (fontFace, size, bold), resolved once
+    key = (fontFace, size, bold)
+    myfont = fonts.get(key)
+    if myfont is None:
+        myfont = pygame.font.SysFont(fontFace, size, bold)
+        fonts[key] = myfont
+    return myfont
+
+def loadFonts():                  # resolve every font the screens use up front
+    for size, bold in ((smallfont, False), (smallfont, True),
+                       (mediumfont, False), (largefont, False)):
+        getFont(size, bold)
+
 def xPos(lbl,j,s,mf):         # determine starting x co-ordinate to place text
     labelwidth = mf.size(lbl)[0]
-    l = [5,65,5,5,5]          # leftmost co-ordinates for screens 0->3
-    r = [320,260,320,320,320] # rightmost co-ordinates for screens 0->3
+    l = [5,65,5,5,5,5]            # leftmost co-ordinates for screens 0->5
+    r = [320,260,320,320,320,320] # rightmost co-ordinates for screens 0->5
     if j==0:
         x = l[s]
     elif j==1:
@@ -621,21 +1951,40 @@ def signal_handler(signal, frame):
 
 # Global stuff -------------------------------------------------------------
 
+bootTimeline    = [('start', monotonic())] # (stage, time) see bootStage
+
 t = threading.Thread(target=timeLapse)
+scheduler       = Scheduler()
+stop_latency    = 0.0     # seconds from Stop press to capture thread exit
+frameLog        = FrameLog('pislide-frames.log')
+profiler        = Profiler()  # enabled by --profile
 busy            = False
 threadExited    = False
 
 backlightState=1
 
+# pygame user events driving the main loop
+REFRESHEVENT    = USEREVENT       # posted by the timelapse thread when status changes
+TICKEVENT       = USEREVENT + 1   # periodic wakeup for the done/ready LED change
+tick_interval   = 1000            # milliseconds between TICKEVENTs
+idle_cpu_target = 2.0             # percent of one core allowed while waiting for events
+loop_started    = None            # main loop start time, for the CPU usage report
+
 screenMode      =  0      # Current screen mode; default = viewfinder
 screenModePrior = -1      # Prior screen mode (for detecting changes)
 returnScreen    = 0
 iconPath        = 'icons' # Subdirectory containing UI bitmaps (PNG format)
+assets          = Assets(iconPath)
 
 whitefont = (255, 255, 255)
 smallfont = 24
 mediumfont = 30
 largefont = 50
+tinyfont = 14
+
+fontFace  = "Arial"
+fonts     = {}                # (face, size, bold) -> pygame Font, see getFont
+textCache = TextCache(64)     # rendered label surfaces
 
 numeric         = 0       # number from numeric keypad
 numberstring	= "0"
@@ -653,21 +2002,34 @@ wshutterpin     = 03
 motorpinA       = 22
 motorpinB       = 27
 motorpin        = motorpinA
+motor           = MotorDriver(motorpinA, motorpinB)
 
-rotatepinA      = 22
-rotatepinB      = 27
+steppin         = 5           # stepper driver STEP
+stepdirpin      = 6           # stepper driver DIR
+stepenablepin   = 12          # stepper driver ENABLE, active low
+steps_per_mm    = 80          # 200 step motor, 1/16 microsteps, 20 tooth GT2 pulley
+stepper_accel   = 300         # mm/s/s
+stepper         = StepperDriver(steps_per_mm, stepper_accel)
+
+rotatepinA      = 19          # rotation head, turning towards PanEnd > PanStart
+rotatepinB      = 26
 rotatepin       = rotatepinA
+head            = MotorDriver(rotatepinA, rotatepinB)
 
 backlightpin    = 252
 
+gpio            = None        # pin backend, see makeBackend
+
 redpin          = 18          # waiting
 greenpin        = 15          # running
 bluepin         = 14          # done
 lastpin         = 0
-doneNotify      = time.time()  # set done notify to now
+now             = time.time    # wall clock, replaced by a VirtualClock when simulating
+doneNotify      = now()  # set done notify to now
 
 consumed_time   = 0.0
 currentframe    = 0
+plan            = ShotPlan()  # rebuilt by timelapseSettings
 
 # fall back defaults - to be removed
 travel_pulse    = 0.0
@@ -684,42 +2046,77 @@ focus_pause     = 0.3
 task_indicator  = "done"
 last_task       = task_indicator
 
+store           = SettingsStore('pislide.json', legacy='pislide.pkl')
+
+# preset picker (screen 5); presets themselves live in store.presets
+presetSlots     = ['Night rail', 'Day slide', 'Product', 'Custom']
+presetColor     = (40, 40, 40)
+presetSaving    = False       # next slot tapped stores the current settings
+presetMessage   = ''
+# starting points for an empty library, see loadSettings
+presetDefaults  = {
+    'Night rail': {"Shutter": 20, "Timespan": 480, "Images": 400,
+                   "Distance": 2000, "Speed": 30, "Settle": 2},
+    'Day slide' : {"Shutter": 1.0 / 250, "Timespan": 60, "Images": 240,
+                   "Distance": 1000, "Speed": 30, "Settle": 1},
+    'Product'   : {"Shutter": 1.0 / 60, "Timespan": 2, "Images": 48,
+                   "Distance": 300, "Speed": 30, "Settle": 0.5}}
+
 dict_idx	    = "Shutter"
 # shutter, settle are in seconds
 # timespan is in minutes
 # distance is in mm
 # speed is mm/s
 # images is a count
+# ramp is the motor's seconds to full speed and back, 0 for none
+# motor is 0 for the DC motor, 1 for the stepper
+# pan start and end are the head's angles in degrees, pan speed degrees/s
+# keyframes are [frame, position] as fractions of the run, see MotionProfile
+# ease is 0 for straight moves between keyframes up to 1 for a full ease
+# shutter end is the last image's shutter for a bulb ramp, 0 for none
+# exposures is an optional table of [frame, seconds], see exposureSchedule
 v = { "Shutter": 2,
     "Timespan": 60,
     "Images": 120,
     "Distance": 2000,
     "Speed": 30,
-    "Settle": 1}
-
-vi = { "Shutter": pygame.image.load(iconPath + '/shutter.png'),
-       "Timespan": pygame.image.load(iconPath + '/timespan.png'),
-       "Images": pygame.image.load(iconPath + '/images.png'),
-       "Distance": pygame.image.load(iconPath + '/distance.png'),
-       "Speed": pygame.image.load(iconPath + '/speed.png'),
-       "Settle": pygame.image.load(iconPath + '/settle.png')}
-
-pi = {"stopping": pygame.image.load(iconPath + '/stopping.png'),
-      "settling": pygame.image.load(iconPath + '/settling.png'),
-      "fire": pygame.image.load(iconPath + '/fire.png'),
-      "travel": pygame.image.load(iconPath + '/travel.png'),
-      "pause": pygame.image.load(iconPath + '/pause.png'),
-      "done": pygame.image.load(iconPath + '/direction.png')}
-
-md = {0: pygame.image.load(iconPath + '/directionleft.png'),
-      1:pygame.image.load(iconPath + '/directionright.png')}
-
-smd = {0: pygame.image.load(iconPath + '/littleleft.png'),
-       1:pygame.image.load(iconPath + '/littleright.png')}
+    "Settle": 1,
+    "Ramp": 0,
+    "Motor": 0,
+    "PanStart": 0,
+    "PanEnd": 0,
+    "PanSpeed": 5,
+    "Keyframes": [[0, 0], [1, 1]],
+    "Ease": 0,
+    "ShutterEnd": 0,
+    "Exposures": []}
+
+# icon names for the overlays, loaded through assets when first shown
+vi = { "Shutter": 'shutter',
+       "Timespan": 'timespan',
+       "Images": 'images',
+       "Distance": 'distance',
+       "Speed": 'speed',
+       "Settle": 'settle'}
+
+pi = {"stopping": 'stopping',
+      "settling": 'settling',
+      "fire": 'fire',
+      "travel": 'travel',
+      "pause": 'pause',
+      "done": 'direction'}
+
+md = {0: 'directionleft',
+      1: 'directionright'}
+
+smd = {0: 'littleleft',
+       1: 'littleright'}
 smdx = {0: 5,
         1: 285}
 
-icons = [] # This list gets populated at startup
+icons = {} # Icon by name, populated at startup by loadIcons
+hitGrids = [] # Touch lookup per screen, see buildHitGrids
+staticLayers = {} # Screen mode -> pre-blended background and buttons
 
 # buttons[] is a list of lists; each top-level list element corresponds
 # to one screen mode (e.g. viewfinder, image playback, storage settings),
@@ -735,6 +2132,7 @@ buttons = [
   [Button((  5,180,120, 60), bg='start',     cb=startCallback, value=1),
    Button((130,180, 60, 60), bg='gear',      cb=viewCallback, value=0),
    Button((195,180,120, 60), bg='stop',      cb=startCallback, value=0),
+   Button((110,110,100, 40), color=presetColor, label='Presets', cb=presetCallback, value=-2),
    Button((  0,  0,320,180), bg='bigbutton', cb=backlightCallback, value=0)],
 
   # Screen 1 for changing values and setting motor direction
@@ -783,39 +2181,461 @@ buttons = [
    Button((240,180, 80, 60), bg='fraction',cb=numericCallback, value=14),
    Button((180, 60,140, 60), bg='cancel',  cb=numericCallback, value=11)],
 
-  # Screen 5 shutdown
+  # Screen 4 shutdown
   [Button((  0,  0,320, 80), bg='return',cb=shutdownPi, value=-1),
-   Button((  0,160,320, 80), bg='shutdown',cb=shutdownPi, value=1)]
+   Button((  0,160,320, 80), bg='shutdown',cb=shutdownPi, value=1)],
+
+  # Screen 5 preset picker, one slot per presetSlots entry
+  [Button((  5,  5,150, 70), color=presetColor, label=presetSlots[0], cb=presetCallback, value=1),
+   Button((165,  5,150, 70), color=presetColor, label=presetSlots[1], cb=presetCallback, value=2),
+   Button((  5, 80,150, 70), color=presetColor, label=presetSlots[2], cb=presetCallback, value=3),
+   Button((165, 80,150, 70), color=presetColor, label=presetSlots[3], cb=presetCallback, value=4),
+   Button((  5,180,120, 55), color=presetColor, label='Save',         cb=presetCallback, value=0),
+   Button((180,180,140, 60), bg='done',                               cb=presetCallback, value=-1)]
 
 ]
 
+# overlays[] parallels buttons[]: the dynamic labels and icons drawn over
+# each screen mode, by name, so the main loop can update them in place.
+
+overlays = [
+
+  # Screen mode 0 status
+  {'shutter'  : Label(0, 10, 0, mediumfont),
+   'pause'    : Label(0, 10, 1, mediumfont),
+   'frames'   : Label(0, 50, 0, mediumfont),
+   'remaining': Label(0, 50, 1, mediumfont),
+   'eta'      : Label(0, 90, 1, mediumfont),
+   'task'     : Overlay(),
+   'direction': Overlay()},
+
+  # Screen 1 parameter values
+  {'Shutter'  : Label(1, 10, 0, smallfont, True),
+   'Timespan' : Label(1, 70, 0, smallfont, True),
+   'Images'   : Label(1,130, 0, smallfont, True),
+   'Distance' : Label(1, 10, 1, smallfont, True),
+   'Settle'   : Label(1, 70, 1, smallfont, True),
+   'Speed'    : Label(1,130, 1, smallfont, True),
+   'direction': Overlay()},
+
+  # Screen 2 & 3 keypad entry and the parameter being edited
+  {'number'   : Label(2,  2, 0, largefont),
+   'icon'     : Overlay()},
+  {'number'   : Label(3,  2, 0, largefont),
+   'icon'     : Overlay()},
+
+  # Screen 4 shutdown
+  {},
+
+  # Screen 5 preset picker result
+  {'message'  : Label(5,155, 2, smallfont, True)}
+
+]
 
 # Assorted utility functions -----------------------------------------------
 
 
 def saveSettings():
-    global v
-    try:
-      outfile = open('pislide.pkl', 'wb')
-      # Use a dictionary (rather than pickling 'raw' values) so
-      # the number & order of things can change without breaking.
-      pickle.dump(v, outfile)
-      outfile.close()
-    except:
-      pass
+    store.current = dict(v)
+    store.save()
 
 def loadSettings():
-    global v
-    try:
-      infile = open('pislide.pkl', 'rb')
-      v = pickle.load(infile)
-      infile.close()
-    except:
-      pass
-              
+    # Loaded values are laid over the defaults in v so settings added
+    # since the file was written keep their defaults.
+    if store.load():
+      v.update(store.current)
+    if not store.presets:
+      store.presets = dict((k, dict(p)) for k, p in presetDefaults.iteritems())
+
+def applySettings(args):          # Key=Value overrides of v, False if one is bad
+    for arg in args:
+        key, equals, value = arg.partition('=')
+        if not equals or key not in v:
+            print "Not a setting: " + arg
+            return False
+        if is_integer(value): v[key] = int(value)
+        elif is_float(value): v[key] = float(value)
+        elif isinstance(v[key], list):    # e.g. Keyframes=[[0,0],[1,1]]
+            try:
+                v[key] = json.loads(value)
+            except ValueError:
+                print "Bad value for %s: %s" % (key, value)
+                return False
+        else:
+            print "Bad value for %s: %s" % (key, value)
+            return False
+    return True
+
+def loadIcons():                  # index the icons directory by name
+    icons.clear()
+    for file in os.listdir(iconPath):
+      if fnmatch.fnmatch(file, '*.png'):
+        name = file.split('.')[0]
+        icons[name] = Icon(name)
+
+def assignIcons():                # give Buttons their Icons, return names not found
+    missing = set()
+    for s in buttons:             # For each screenful of buttons...
+      for b in s:                 #  For each button on screen...
+        if b.bg:
+          b.iconBg = icons.get(b.bg)
+          if b.iconBg: b.bg = None # Name no longer used; allow garbage collection
+          else:        missing.add(b.bg)
+        if b.fg:
+          b.iconFg = icons.get(b.fg)
+          if b.iconFg: b.fg = None
+          else:        missing.add(b.fg)
+    # and the icons the status overlays show
+    for table in (vi, pi, md, smd):
+      for name in table.itervalues():
+        if name not in icons: missing.add(name)
+    return missing
+
+def bootStage(name):              # mark the end of a startup stage
+    bootTimeline.append((name, monotonic()))
+
+def bootReport():
+    print "Boot timeline:"
+    prior = bootTimeline[0][1]
+    for name, when in bootTimeline[1:]:
+        print "  %-12s +%4.0fms  %5.0fms" % (
+            name, 1000.0 * (when - prior), 1000.0 * (when - bootTimeline[0][1]))
+        prior = when
+
+def buildHitGrids():              # one HitGrid per screen, after buttons[] is final
+    global hitGrids
+    hitGrids = [HitGrid(s) for s in buttons]
+
+def benchTouch(n=20000):          # touch lookup cost, list scan vs HitGrid
+    import random
+    buildHitGrids()
+    for s, grid in enumerate(hitGrids):
+        touches = [(random.randrange(320), random.randrange(240)) for i in range(n)]
+        start = monotonic()
+        for pos in touches:
+            for b in buttons[s]:
+                if b.contains(pos): break
+        scan = (monotonic() - start) / n
+        start = monotonic()
+        for pos in touches:
+            grid.find(pos)
+        direct = (monotonic() - start) / n
+        print "Screen %d: %2d buttons, %dpx cells, scan %.2fus, grid %.2fus" % (
+            s, len(buttons[s]), grid.cell, 1e6 * scan, 1e6 * direct)
+
+def pinNames():                   # pin number -> name, for event listings
+    names = {}
+    for name in ('bluepin', 'greenpin', 'redpin', 'wfocuspin', 'wshutterpin',
+                 'focuspin', 'shutterpin', 'motorpinB', 'motorpinA',
+                 'rotatepinA', 'rotatepinB', 'steppin', 'stepdirpin',
+                 'stepenablepin', 'backlightpin'):
+        names[globals()[name]] = name.replace('pin', '')
+    return names
+
+def simulate(args):               # run the saved plan headless on a virtual clock
+    # args are optional overrides of v, e.g. Images=500 Shutter=0.5
+    global gpio, scheduler, motor, head, stepper, now, busy, frameLog
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()         # only so notifyUI has an event queue
+
+    frameLog  = FrameLog('pislide-sim-frames.log')  # keep the real log clean
+    clock     = VirtualClock()
+    now       = clock.now
+    gpio      = SimulatedBackend(clock.now, size=None)  # keep every step
+    scheduler = Scheduler(clock.now, clock.sleep)
+    motor     = MotorDriver(motorpinA, motorpinB)
+    head      = MotorDriver(rotatepinA, rotatepinB)
+    stepper   = StepperDriver(steps_per_mm, stepper_accel)
+
+    loadSettings()
+    if not applySettings(args): return
+    reasonableValues()
+    if timelapseSettings():
+        print "Invalid timing, pause time %.2fs" % pause_time
+        return
+
+    scheduler.arm()
+    busy = True
+    timeLapse()
+
+    names = pinNames()
+    for when, pin, value in gpio.transitions:
+        if pin == steppin: continue  # counted below
+        print "%12.4f %-8s %s" % (when, names.get(pin, pin), ('LOW', 'HIGH')[value])
+    if gpio.duty:
+        # duty steps of the first ramped move, ending with the first stop
+        print "First move duty profile:"
+        for when, pin, duty in gpio.duty:
+            if when == 0.0 and duty == 0: continue  # softPwmCreate
+            print "%12.4f %-8s %3d%%" % (when, names.get(pin, pin), duty)
+            if duty == 0: break
+    frameLog.close()
+    print "Frames.........." + str(len(gpio.pulses(shutterpin)))
+    if any(plan.steps):
+        print "Steps.......... %d, carriage at %.3fmm" % (
+            len(gpio.pulses(steppin)), float(stepper.position) / steps_per_mm)
+    print "Drift..........%.6fs" % scheduler.drift()
+    print "Consumed.......%.1fs of %ds" % (clock.now(), int(v['Timespan']) * 60)
+
+def percentile(values, q):        # nearest rank percentile, q in 0..100
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+# representative plans for benchTiming
+benchConfigs = [
+    ('fast 1/8000', {"Shutter": 1.0 / 8000, "Timespan": 10, "Images": 100,
+                     "Distance": 500, "Speed": 30, "Settle": 0.5}),
+    ('90s exposures', {"Shutter": 90, "Timespan": 240, "Images": 100,
+                       "Distance": 1000, "Speed": 30, "Settle": 1}),
+    ('500 images', {"Shutter": 1, "Timespan": 600, "Images": 500,
+                    "Distance": 2000, "Speed": 30, "Settle": 1})]
+
+def benchTiming(realSeconds=3.0): # pulse and interval accuracy of timeLapse
+    # Each plan runs against the simulated backend twice: on a virtual
+    # clock (the scheduler's arithmetic alone) and on the real clock
+    # compressed to about realSeconds of wall time.  Errors are given
+    # in real milliseconds: |pulse width - planned|, |shutter to
+    # shutter interval - planned| and the drift at the last deadline.
+    global gpio, scheduler, motor, head, now, busy, frameLog
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()
+    frameLog = FrameLog(os.devnull)
+    defaults = dict(v)
+    for name, config in benchConfigs:
+        v.clear()
+        v.update(defaults)
+        v.update(config)
+        reasonableValues()
+        if timelapseSettings():
+            print "%s: invalid timing, skipped" % name
+            continue
+        for mode in ('virtual', 'real'):
+            if mode == 'virtual':
+                clock = VirtualClock()
+                factor = 1.0
+            else:
+                factor = max(1.0, plan.total() / realSeconds)
+                clock = ScaledClock(factor)
+            now       = clock.now
+            gpio      = SimulatedBackend(clock.now)
+            motor     = MotorDriver(motorpinA, motorpinB)
+            head      = MotorDriver(rotatepinA, rotatepinB)
+            scheduler = Scheduler(clock.now, clock.sleep, factor)
+            scheduler.arm()
+            busy = True
+            timeLapse()
+
+            shots = gpio.pulses(shutterpin)
+            moves = gpio.pulses(motorpinA) + gpio.pulses(motorpinB)
+            opens = [plan.start[i] + plan.travel[i] + plan.settle[i] + plan.focus[i]
+                     for i in range(len(plan))]
+            width = [abs((f - r) - plan.exposure[i]) for i, (r, f) in enumerate(shots)]
+            width += [abs((f - r) - plan.slide[i + 1]) for i, (r, f) in enumerate(moves)]
+            interval = [abs((shots[i][0] - shots[i - 1][0]) - (opens[i] - opens[i - 1]))
+                        for i in range(1, len(shots))]
+            scale = 1000.0 / factor   # to real milliseconds
+            print "%-14s %-7s %3d frames  pulse p50/p95/p99/max %.3f/%.3f/%.3f/%.3fms" % (
+                name, mode, len(shots),
+                scale * percentile(width, 50), scale * percentile(width, 95),
+                scale * percentile(width, 99), scale * percentile(width, 100))
+            print "%-22s interval p50/p95/p99/max %.3f/%.3f/%.3f/%.3fms  drift %.3fms" % (
+                '', scale * percentile(interval, 50), scale * percentile(interval, 95),
+                scale * percentile(interval, 99), scale * percentile(interval, 100),
+                scale * scheduler.drift())
+
+def benchStop(runs=5):            # Stop latency from each phase of a running timelapse
+    # A short plan runs on the simulated backend against the real clock.
+    # Stop is pressed part way into each phase in turn and the time until
+    # the capture thread has exited is recorded.  Last, a pause pressed
+    # with the shutter open checks the exposure still closes on time.
+    global gpio, scheduler, motor, head, plan, frameLog
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()         # only so notifyUI has an event queue
+    frameLog  = FrameLog(os.devnull)
+    gpio      = SimulatedBackend()
+    motor     = MotorDriver(motorpinA, motorpinB)
+    head      = MotorDriver(rotatepinA, rotatepinB)
+    scheduler = Scheduler()
+    plan = ShotPlan()
+    for i in range(3):
+        plan.append(0.4 if i else 0.0, 0.4, 0.4, 0.4, 0.4, slide=0.4 if i else 0.0)
+
+    def shutterOpen():
+        return gpio.levels.get(shutterpin) == gpio.HIGH
+    phases = [('travel',  lambda: task_indicator == 'travel'),
+              ('settle',  lambda: task_indicator == 'settling'),
+              ('focus',   lambda: task_indicator == 'fire' and not shutterOpen()),
+              ('shutter', shutterOpen),
+              ('pause',   lambda: task_indicator == 'pause')]
+    results = []
+    for name, inPhase in phases:
+        took = []
+        for r in range(runs):
+            startCallback(1)
+            while not inPhase(): time.sleep(0.001)
+            time.sleep(0.1)
+            startCallback(0)
+            took.append(stop_latency)
+        results.append("Stop in %-8s mean %.2fms, worst %.2fms" % (
+            name, 1000.0 * sum(took) / len(took), 1000.0 * max(took)))
+
+    gpio.transitions.clear()
+    startCallback(1)
+    while not shutterOpen(): time.sleep(0.001)
+    startCallback(1)              # pause with the shutter open
+    time.sleep(0.5)
+    startCallback(1)              # and resume
+    while task_indicator != 'pause': time.sleep(0.001)
+    startCallback(0)
+    rise, fall = gpio.pulses(shutterpin)[0]
+    results.append("Paused with the shutter open: exposure %.1fms of %.1fms planned" % (
+        1000.0 * (fall - rise), 1000.0 * plan.exposure[0]))
+    print '\n'.join(results)
+
+def drawBackground(screen):
+    if img is None or img.get_height() < 240: # Letterbox, clear background
+        screen.fill(0)
+    if img:
+        screen.blit(img,
+          ((320 - img.get_width() ) / 2,
+          (240 - img.get_height()) / 2))
+
+def staticLayer(s):               # screen s background and buttons pre-blended
+    # Rebuilt only when a Button on the screen has changed (setBg) or
+    # on first use, so a repaint is one blit plus the overlays.
+    layer = staticLayers.get(s)
+    if layer is None or any(b.dirty for b in buttons[s]):
+        if layer is None:
+            layer = pygame.Surface(screen.get_size(), 0, screen)
+            staticLayers[s] = layer
+        drawBackground(layer)
+        for b in buttons[s]:
+            b.draw(layer)
+    return layer
+
+def paintScreen(s, full):     # composite screen mode s, return rects to update
+    # A full paint redraws everything (screen changes); otherwise only
+    # the areas of dirty buttons and overlays are recomposited, clipped,
+    # from the static layer up so overlapping items stay correctly stacked.
+    layer = staticLayer(s)
+    profiler.lap('buttons')
+    if full:
+        areas = [screen.get_rect()]
+    else:
+        areas = [pygame.Rect(b.rect) for b in buttons[s] if b.dirty]
+        areas += [o.area() for o in overlays[s].itervalues()
+                  if o.dirty and o.area()]
+    for area in areas:
+        screen.blit(layer, area, area)
+        screen.set_clip(area)
+        for o in overlays[s].itervalues():
+            if o.rect and area.colliderect(o.rect): o.draw(screen)
+    screen.set_clip(None)
+    for b in buttons[s]: b.dirty = False
+    for o in overlays[s].itervalues(): o.flushed()
+    return areas
+
+def benchRender(n=200):           # repaint cost per screen, full redraw vs partial update
+    # The old loop redrew the background, every button and every label and
+    # flushed the whole screen on each repaint.  paintScreen recomposites
+    # only what changed over the static layer and flushes just those
+    # rects.  Each repaint here changes the labels that change in use (the
+    # frame count and time left while running, a keyed in number, ...).
+    # The dummy display flushes for free, so the pixels each path sends to
+    # the framebuffer are given too.
+    global screen, img
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()
+    pygame.font.init()            # the preset screen's buttons have labels
+    screen = pygame.display.set_mode((320, 240), 0, 16)
+    img = assets.get('PiSlide')
+    loadIcons()
+    assignIcons()
+    changing = {0: ('frames', 'remaining'), 1: ('Images',), 2: ('number',),
+                3: ('number',), 5: ('message',)}
+    size = screen.get_width() * screen.get_height()
+    for s in range(len(buttons)):
+        labels = [(name, o) for name, o in overlays[s].iteritems()
+                  if isinstance(o, Label)]
+        for name, o in labels: o.setText(name)
+        paintScreen(s, True)
+        names = changing.get(s, ())
+        start = monotonic()
+        for i in range(n):
+            drawBackground(screen)
+            for b in buttons[s]:
+                b.draw(screen)
+            for name, o in labels:
+                text = '%s %d' % (name, i) if name in names else name
+                screen.blit(getFont(o.size, o.bold).render(text, 1, whitefont), o.pos)
+            for o in overlays[s].itervalues():
+                if not isinstance(o, Label): o.draw(screen)
+            pygame.display.update()
+        full = (monotonic() - start) / n
+        flushed = 0
+        start = monotonic()
+        for i in range(n):
+            for name in names:
+                overlays[s][name].setText('%s %d' % (name, i))
+            rects = paintScreen(s, False)
+            if rects:
+                pygame.display.update(rects)
+                flushed += sum(r.width * r.height for r in rects)
+        partial = (monotonic() - start) / n
+        if not names:
+            print "Screen %d: full %.3fms, %dpx; no labels change" % (
+                s, 1000.0 * full, size)
+            continue
+        print "Screen %d: full %.3fms, %dpx; partial %.3fms, %dpx (%.1fx)" % (
+            s, 1000.0 * full, size, 1000.0 * partial, flushed / n,
+            full / max(partial, 1e-9))
 
 # Initialization -----------------------------------------------------------
 
+# Command line modes that run instead of the controller
+if '--bench-backlight' in sys.argv:
+    benchBacklight()
+    sys.exit()
+if '--plan' in sys.argv:          # print the shot plan for the saved settings
+    loadSettings()
+    reasonableValues()
+    timelapseSettings()
+    plan.dump(sys.stdout)
+    sys.exit()
+if '--bench-touch' in sys.argv:
+    benchTouch()
+    sys.exit()
+if '--bench-render' in sys.argv:
+    benchRender()
+    sys.exit()
+if '--bench-timing' in sys.argv:
+    benchTiming()
+    sys.exit()
+if '--bench-stop' in sys.argv:
+    benchStop()
+    sys.exit()
+if '--simulate' in sys.argv:
+    simulate(sys.argv[sys.argv.index('--simulate') + 1:])
+    sys.exit()
+if '--set' in sys.argv:           # save settings that have no button, e.g. Ramp=1.5
+    loadSettings()
+    args = sys.argv[sys.argv.index('--set') + 1:]
+    if not applySettings(args): sys.exit(1)
+    reasonableValues()
+    saveSettings()
+    for arg in args:
+        key = arg.split('=', 1)[0]
+        print "%s = %s" % (key, json.dumps(v[key]))
+    sys.exit()
+
+# Debug mode: time each repaint, show the rolling stage times along the
+# bottom of every screen and write the histograms on exit
+if '--profile' in sys.argv:
+    profiler.enabled = True
+    for s, o in enumerate(overlays):
+        o['profile'] = Label(s, 224, 0, tinyfont)
+
 # Init framebuffer/touchscreen environment variables
 os.putenv('SDL_VIDEODRIVER', 'fbcon')
 os.putenv('SDL_FBDEV'      , '/dev/fb1')
@@ -825,9 +2645,24 @@ os.putenv('SDL_MOUSEDEV'   , '/dev/input/touchscreen')
 # --------
 try:  # capture exceptions
 
+    # Startup is staged so the splash is up as early as possible: the
+    # display alone first, then GPIO, fonts and the UI tables, while the
+    # remaining bitmaps load on a background thread.
+
+    # Init the display (only the pygame modules used) and show the splash
+    print "Setting fullscreen..."
+    pygame.display.init()
+    pygame.mouse.set_visible(False)
+    modes = pygame.display.list_modes(16)
+    screen = pygame.display.set_mode(modes[0], FULLSCREEN, 16)
+    img    = assets.get('PiSlide')
+    drawBackground(screen)
+    pygame.display.update()
+    bootStage('splash')
+
     # Set up GPIO pins
     print "Init GPIO pins..."
-    gpio = wiringpi2.GPIO(wiringpi2.GPIO.WPI_MODE_GPIO)
+    gpio = makeBackend()
     gpio.pinMode(shutterpin,gpio.OUTPUT)
     gpio.pinMode(focuspin,gpio.OUTPUT)
     gpio.pinMode(wshutterpin,gpio.OUTPUT)
@@ -837,45 +2672,41 @@ try:  # capture exceptions
     gpio.pinMode(redpin,gpio.OUTPUT)
     gpio.pinMode(bluepin,gpio.OUTPUT)
     gpio.pinMode(greenpin,gpio.OUTPUT)
-    gpio.digitalWrite(motorpinA,gpio.LOW)
-    gpio.digitalWrite(motorpinB,gpio.LOW)
+    gpio.pinMode(rotatepinA,gpio.OUTPUT)
+    gpio.pinMode(rotatepinB,gpio.OUTPUT)
+    gpio.pinMode(steppin,gpio.OUTPUT)
+    gpio.pinMode(stepdirpin,gpio.OUTPUT)
+    gpio.pinMode(stepenablepin,gpio.OUTPUT)
+    motor.stop()
+    head.stop()
+    stepper.enable(False)
 
     # set external LED to start value
     #print 'setLED 1'
     setLED("start")
     
-    # I couldnt seem to get at pin 252 for the backlight using the usual method above,
-    # but this seems to work
-    os.system("echo 252 > /sys/class/gpio/export")
-    os.system("echo 'out' > /sys/class/gpio/gpio252/direction")
-    os.system("echo '1' > /sys/class/gpio/gpio252/value")
-
-    # Init pygame and screen
-    print "Initting..."
-    pygame.init()
-    print "Setting Mouse invisible..."
-    pygame.mouse.set_visible(False)
-    print "Setting fullscreen..."
-    modes = pygame.display.list_modes(16)
-    screen = pygame.display.set_mode(modes[0], FULLSCREEN, 16)
-
-    print "Loading Icons..."
-    # Load all icons at startup.
-    for file in os.listdir(iconPath):
-      if fnmatch.fnmatch(file, '*.png'):
-        icons.append(Icon(file.split('.')[0]))
-    # Assign Icons to Buttons, now that they're loaded
+    gpio.exportBacklight()
+    gpio.setBacklight(1)
+    bootStage('gpio')
+
+    print "Listing Icons..."
+    # Name all icons at startup; their bitmaps load on first draw or
+    # in the background, whichever comes first.
+    loadIcons()
+    assets.preload(sorted(icons))
+    # Assign Icons to Buttons, now that they're named
     print"Assigning Buttons"
-    for s in buttons:        # For each screenful of buttons...
-      for b in s:            #  For each button on screen...
-        for i in icons:      #   For each icon...
-          if b.bg == i.name: #    Compare names; match?
-            b.iconBg = i     #     Assign Icon to Button
-            b.bg     = None  #     Name no longer used; allow garbage collection
-          if b.fg == i.name:
-            b.iconFg = i
-            b.fg     = None
+    missing = assignIcons()
+    if missing:
+      print "Missing icons: " + ', '.join(sorted(missing))
+
+    buildHitGrids()
+    bootStage('icons')
 
+    print "Loading fonts..."
+    pygame.font.init()
+    loadFonts()
+    bootStage('fonts')
 
     print"Load Settings"
     # Get settings from pickle, validate them and set timelapse execution
@@ -883,30 +2714,24 @@ try:  # capture exceptions
     reasonableValues() # Validate that the execution parms make sense
     if timelapseSettings():         # Calculate timelapse execution values
         task_indicator = 'stopping'
-
-    print "loading background.."
-    img    = pygame.image.load("icons/PiSlide.png")
-
-    # define the screen background from the image
-    if img is None or img.get_height() < 240: # Letterbox, clear background
-      screen.fill(0)
-    if img:
-      screen.blit(img,
-        ((320 - img.get_width() ) / 2,
-         (240 - img.get_height()) / 2))
-    # show the screen
-    pygame.display.update()
-    time.sleep(1)
+    bootStage('settings')
 
     # Main loop ----------------------------------------------------------------
 
     signal.signal(signal.SIGTERM, signal_handler)
 
     print "mainloop.."
+    pygame.time.set_timer(TICKEVENT, tick_interval)
+    loop_started = time.time()
+    loop_cpu     = os.times()
+    wakeups      = 0
+    repaints     = 0
+    flushed      = 0              # pixels pushed to the framebuffer
+    dirty        = True           # paint the first frame without waiting
     while True:
     # loop until ^C
     #
-    # 1. capture event loop until button pushed, not on screen 0 or screen change
+    # 1. block until an event arrives (touch, timelapse status change or tick)
     # 2. blit background
     # 3. draw icons and buttons based on current screen
     # 4. blit screen specific output based on current screen - screenMode
@@ -915,69 +2740,61 @@ try:  # capture exceptions
 
         # on completion of timelapse set 'ready' LED on after 'done' LED
         if busy == False:
-            if time.time() > doneNotify:
+            if now() > doneNotify:
                 #print 'setLED 2'
                 setLED("ready")
             else:
                 #print 'setLED 3'
                 setLED("done")
-            
-        # Process touchscreen input
-        while True:
-
-            for event in pygame.event.get():
-              if(event.type is MOUSEBUTTONDOWN):
-                pos = pygame.mouse.get_pos()
-                for b in buttons[screenMode]:
-                  if b.selected(pos): break
-              # why shut off the motor on mouse up ??????????
-              elif(event.type is MOUSEBUTTONUP):
-                motorRunning = 0
-                gpio.digitalWrite(motorpinA,gpio.LOW)
-                gpio.digitalWrite(motorpinB,gpio.LOW)
-
-            # if not on screen 0 or changing screens then leave event loop
-            if screenMode >= 0 or screenMode != screenModePrior: break
-
-            # first time through break out due to screen mode !=
-            # break out when not on screen 0
-            # break out when changing screens (effect only affects screen 1->0 flow)
-
-
-        if img is None or img.get_height() < 240: # Letterbox, clear background
-            screen.fill(0)
-        if img:
-            screen.blit(img,
-              ((320 - img.get_width() ) / 2,
-              (240 - img.get_height()) / 2))
-
-        # Overlay buttons on display and update
-        for i,b in enumerate(buttons[screenMode]):
-            b.draw(screen)
+
+        # Process touchscreen input, sleeping in the event queue when idle
+        if dirty:
+            events = pygame.event.get()
+        else:
+            events = [pygame.event.wait()] + pygame.event.get()
+            wakeups += 1
+        profiler.begin()
+
+        for event in events:
+          if(event.type is MOUSEBUTTONDOWN):
+            b = hitGrids[screenMode].find(pygame.mouse.get_pos())
+            if b: b.fire()
+            dirty = True
+          # why shut off the motor on mouse up ??????????
+          elif(event.type is MOUSEBUTTONUP):
+            if motorRunning:      # only a manual jog ends with the touch
+              motorRunning = 0
+              jogStop()
+          elif(event.type is REFRESHEVENT):
+            dirty = True
+
+        # nothing visible changed (e.g. a TICKEVENT), go back to sleep
+        if not dirty: continue
+        profiler.lap('events')
 
     # debug
     #  print "screenMode..........." + str(screenMode)
     #  print "screenModePrior......" + str(screenModePrior)
     #  print "motorDirection......." + str(motorDirection)
     #  print "motorDirectionPrior.." + str(motorDirectionPrior)
-    
+
+    # Update this screen's overlays; only those whose content changed
+    # are recomposited below.
+        o = overlays[screenMode]
+
     # keypad screens
         if screenMode == 3 or screenMode == 2:
-            myfont = pygame.font.SysFont("Arial", largefont)
-            myfont.set_bold(False)
-            label = myfont.render(numberstring , 1, (whitefont))
-            screen.blit(label, (xPos(numberstring,0,screenMode,myfont), 2))
-            # blit the icon of the button pushed to get here
-            screen.blit(vi[dict_idx], (260, 0))
+            o['number'].setText(numberstring)
+            # the icon of the button pushed to get here
+            o['icon'].set(assets.get(vi[dict_idx]), (260, 0))
 
+        # preset picker
+        if screenMode == 5:
+            o['message'].setText(presetMessage)
 
         # parameter screen
         if screenMode == 1:
-        #  if  ((screenMode==1 and screenMode != screenModePrior)
-        #   or (screenMode==1 and motorDirection != motorDirectionPrior)):
             motorDirectionPrior = motorDirection
-            myfont = pygame.font.SysFont("Arial", smallfont)
-            myfont.set_bold(True)
 
             sValue = float(v['Shutter'])
             if (sValue < 1):
@@ -986,69 +2803,55 @@ try:  # capture exceptions
             else:
                 numeric = int(sValue)
                 labeltext = str(numeric) + "s"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,0,screenMode,myfont), 10))
-
-            labeltext = str(v['Timespan']) + "min"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,0,screenMode,myfont), 70))
-
-            labeltext = str(v['Images'])
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,0,screenMode,myfont), 130))
+            o['Shutter'].setText(labeltext)
 
-            labeltext = str(v['Distance']) + "mm"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,1,screenMode,myfont), 10))
+            o['Timespan'].setText(str(v['Timespan']) + "min")
+            o['Images'].setText(str(v['Images']))
+            o['Distance'].setText(str(v['Distance']) + "mm")
 
             sValue = float(v['Settle'])
             if (sValue == 0):
                 numeric = int(sValue)
-                label = myfont.render(str(numeric) + "s" , 1, (whitefont))
+                labeltext = str(numeric) + "s"
             elif (sValue < 1):
                 numeric = int(1 / sValue)
                 labeltext = "1/" + str(numeric) + "s"
             else:
                 numeric = int(sValue)
                 labeltext = str(numeric) + "s"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,1,screenMode,myfont), 70))
+            o['Settle'].setText(labeltext)
 
-            labeltext = str(v['Speed']) + "mm/s"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,1,screenMode,myfont), 130))
+            o['Speed'].setText(str(v['Speed']) + "mm/s")
         #   current motor direction
-            screen.blit(md[motorDirection], (60 ,180))
+            o['direction'].set(assets.get(md[motorDirection]), (60 ,180))
 
         # initial (home) screen
         if screenMode == 0:
-            myfont = pygame.font.SysFont("Arial", mediumfont)
-            myfont.set_bold(False)
-
-            if task_indicator != last_task:
-                screen.blit(pi[task_indicator], (130, 2))
+            o['task'].set(assets.get(pi[task_indicator]), (130, 2))
 
+            # while running, the shutter and pause of the image coming up,
+            # which change through a bulb ramp
             sValue = float(v['Shutter'])
+            pValue = pause_time
+            if busy and currentframe < len(plan):
+                sValue = plan.exposure[currentframe]
+                pValue = plan.pause[currentframe]
             if (sValue < 1):
                 numeric = int(1 / sValue)
                 labeltext = "1/" + str(numeric) + "s"
             else:
                 numeric = int(sValue)
                 labeltext = str(numeric) + "s"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,0,screenMode,myfont), 10))
+            o['shutter'].setText(labeltext)
         #   pause time
-            labeltext = str(round(pause_time,0)) + "s"
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,1,screenMode,myfont), 10))
-            
+            o['pause'].setText(str(round(pValue,0)) + "s")
+
         #   images remaining
-            labeltext = str(currentframe) + " of " + str(v['Images'])
-            label = myfont.render(labeltext , 1, (whitefont))
-            screen.blit(label, (xPos(labeltext,0,screenMode,myfont), 50))
+            o['frames'].setText(str(currentframe) + " of " + str(v['Images']))
         #   time remaining
         #    remaining = float((frame_interval * (v['Images'] - currentframe)))
-            remaining = round((float(v['Timespan']) * 60) - consumed_time,1)
+            remaining = round(plan.remaining(consumed_time),1)
+            labeltext = None
             if remaining > 0:
                 sec = timedelta(seconds=int(remaining))
                 d = datetime(1,1,1) + sec
@@ -1056,17 +2859,37 @@ try:  # capture exceptions
                     labeltext = "%dh%dm%ds" % (d.hour, d.minute, d.second)
                 else:
                     labeltext = "%dm%ds" % (d.minute, d.second)
-                label = myfont.render(labeltext , 1, (whitefont))
-                screen.blit(label, (xPos(labeltext,1,screenMode,myfont), 50))
+            o['remaining'].setText(labeltext)
+        #   estimated finish while running
+            labeltext = None
+            if busy and remaining > 0:
+                eta = datetime.now() + timedelta(seconds=int(remaining))
+                labeltext = eta.strftime("ETA %H:%M")
+            o['eta'].setText(labeltext)
         #   show the motor direction
-            screen.blit(smd[motorDirection], (smdx[motorDirection],150))
+            o['direction'].set(assets.get(smd[motorDirection]), (smdx[motorDirection],150))
 
         #   run time
         #    labeltext = str(round(travel_pulse,0)) + "s"
         #    label = myfont.render(labeltext , 1, (whitefont))
         #    screen.blit(label, (xPos(labeltext,1,screenMode,myfont), 90))
 
-        pygame.display.update()
+        if profiler.enabled:
+            o['profile'].setText(profiler.summary())
+        profiler.lap('text')
+
+        # full repaint on a screen change, otherwise only what changed
+        rects = paintScreen(screenMode, screenMode != screenModePrior)
+        profiler.lap('composite')
+        if rects:
+            pygame.display.update(rects)
+            flushed += sum(r.width * r.height for r in rects)
+        profiler.lap('update')
+        if repaints == 0:
+            bootStage('first frame')
+            bootReport()
+        repaints += 1
+        dirty = False
 
         screenModePrior = screenMode
 
@@ -1075,6 +2898,20 @@ except KeyboardInterrupt:
     # exits when you press CTRL+C
     print "."
     print "CTRL+C Out!"
+    # report how hard the main loop worked while waiting on events
+    if loop_started:
+        elapsed = time.time() - loop_started
+        used    = os.times()
+        cpu     = (used[0] - loop_cpu[0]) + (used[1] - loop_cpu[1])
+        cpuPct  = 100.0 * cpu / max(elapsed, 0.001)
+        print "Main loop: %d wakeups, %d repaints, %.1f%% CPU (target < %.1f%%)" % (
+            wakeups, repaints, cpuPct, idle_cpu_target)
+        assets.report()
+        print "Text cache: %d hits, %d misses, %d fonts" % (
+            textCache.hits, textCache.misses, len(fonts))
+        if repaints:
+            print "Display: %d pixels/repaint (full screen is %d)" % (
+                flushed / repaints, 320 * 240)
       
 #except:
     # this catches ALL other exceptions including errors.
@@ -1084,5 +2921,8 @@ except KeyboardInterrupt:
       
 finally:
 #   GPIO.cleanup() # this ensures a clean exit
-    gpioCleanup
+    if gpio: gpioCleanup()
+    frameLog.close()
+    if profiler.enabled:
+        profiler.dump('pislide-profile.txt')
     print "Done"